@@ -1,12 +1,26 @@
+import codecs
+import csv
 import datetime
 import json
 import os
+import textwrap
+import zipfile
 from os.path import join
 
+import openpyxl
 import pandas as pd
 import logging
+from charset_normalizer import from_bytes
 
-accepted_extensions = [".xls", ".csv", ".xlsx"]
+accepted_extensions = [".xls", ".csv", ".xlsx", ".tsv"]
+# Indentation of the BioC JSON output files
+json_indent = 4
+# Delimited text files are read in chunks, each of which becomes a separate BioC table
+delimited_extensions = {".csv": ",", ".tsv": "\t"}
+sniffed_delimiters = ",\t;|"
+sniff_sample_size = 64 * 1024
+max_table_rows = 10000
+byte_order_marks = [(codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")]
 logging.basicConfig(filename="ExcelExtractor.log", level=logging.ERROR, format="%(asctime)s - %(levelname)s - %("
                                                                                "message)s")
 
@@ -29,7 +43,8 @@ class BioCTable:
         Builds a table passage based on the provided table_data and adds it to the passages list.
 
         Args:
-            table_data: A pandas DataFrame containing the data for the table.
+            table_data: A pandas DataFrame containing the data for the table, or a tuple of the column headings
+                and an iterable of the table rows.
 
         Returns:
             None
@@ -72,8 +87,12 @@ class BioCTable:
                 }
             ]
         }
+        if isinstance(table_data, pd.DataFrame):
+            columns, rows = table_data.columns.values, table_data.values
+        else:
+            columns, rows = table_data
         # Populate column headings
-        for i, text in enumerate(table_data.columns.values):
+        for i, text in enumerate(columns):
             passage["column_headings"].append(
                 {
                     "cell_id": self.id + F".1.{i + 1}",
@@ -81,7 +100,7 @@ class BioCTable:
                 }
             )
         # Populate table rows with cell data
-        for row_idx, row in enumerate(table_data.values):
+        for row_idx, row in enumerate(rows):
             new_row = []
             for cell_idx, cell in enumerate(row):
                 new_cell = {
@@ -107,14 +126,24 @@ def get_tables_bioc(tables, filename, textsource="Auto-CORPus"):
         A BioC format representation of the extracted tables.
     """
     # Create a BioC dictionary
-    bioc = {
+    bioc = get_bioc_header()
+    bioc["documents"] = [BioCTable(i + 1, x, textsource).__dict__ for i, x in enumerate(tables)]
+    return bioc
+
+
+def get_bioc_header():
+    """
+    Builds the collection level fields of a BioC output file.
+
+    Returns:
+        A BioC dictionary without any documents.
+    """
+    return {
         "source": "Auto-CORPus (supplementary)",
         "date": str(datetime.date.today().strftime("%Y%m%d")),
         "key": "autocorpus_supplementary.key",
         "infons": {},
-        "documents": [BioCTable(i + 1, x, textsource).__dict__ for i, x in enumerate(tables)]
     }
-    return bioc
 
 
 def replace_unicode(text):
@@ -151,6 +180,151 @@ def replace_unicode(text):
         return clean_text
 
 
+def iter_worksheet_rows(worksheet):
+    """
+    Reads the rows of a read-only openpyxl worksheet, with headings and blank rows handled as pandas.read_excel does.
+
+    Empty cells become "nan", blank headings become "Unnamed: <index>" and repeated headings are numbered
+    ("id", "id.1", ...). Blank rows at the end of the sheet are dropped, while blank rows between data rows are
+    kept. Cell values are given as stored in the workbook, as pandas' per-column type conversion would need the
+    whole sheet to be read first. A whole number in a column with empty cells is therefore written as "1" where
+    pandas gives "1.0", and dates keep the type openpyxl reads them as.
+
+    Args:
+        worksheet: An openpyxl worksheet opened in read-only mode.
+
+    Returns:
+        A tuple of the column headings and a generator of the data rows.
+    """
+    rows = worksheet.iter_rows(values_only=True)
+    header = next(rows, None) or ()
+    columns = [F"Unnamed: {i}" if x is None else x for i, x in enumerate(header)]
+    # Numbered as pandas does: named headings before blank ones, skipping numbers already used by a heading
+    counts = {}
+    unnamed = [i for i, x in enumerate(header) if x is None]
+    for i in [i for i in range(len(columns)) if i not in unnamed] + unnamed:
+        column = columns[i]
+        count = counts.get(column, 0)
+        while count > 0:
+            counts[columns[i]] = count + 1
+            column = F"{columns[i]}.{count}"
+            count = count + 1 if column in columns else counts.get(column, 0)
+        columns[i] = column
+        counts[column] = count + 1
+
+    def data_rows():
+        blank_rows = 0
+        for row in rows:
+            if all([x is None for x in row]):
+                # Only emitted once a later row holds data
+                blank_rows += 1
+                continue
+            for i in range(blank_rows):
+                yield ["nan"] * len(columns)
+            blank_rows = 0
+            cells = ["nan" if x is None else x for x in row]
+            yield cells + ["nan"] * (len(columns) - len(cells))
+
+    return columns, data_rows()
+
+
+def sniff_encoding(sample):
+    """
+    Identifies the text encoding of a file from a sample of its leading bytes.
+
+    Args:
+        sample: The leading bytes of the file.
+
+    Returns:
+        The name of the encoding, preferring UTF-8 when the sample is valid UTF-8.
+    """
+    for bom, encoding in byte_order_marks:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # the sample may end part way through a multibyte character
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        match = from_bytes(sample).best()
+        return match.encoding if match else "latin-1"
+
+
+def sniff_delimiter(sample_text, filename):
+    """
+    Identifies the delimiter of a delimited text file, falling back to the one implied by its extension.
+
+    Args:
+        sample_text: The leading text of the file.
+        filename: The path of the file.
+
+    Returns:
+        The delimiter character.
+    """
+    try:
+        return csv.Sniffer().sniff(sample_text, delimiters=sniffed_delimiters).delimiter
+    except csv.Error:
+        return delimited_extensions.get(os.path.splitext(filename)[-1].lower(), ",")
+
+
+def is_delimited_file(filename):
+    return os.path.splitext(str(filename))[-1].lower() in delimited_extensions
+
+
+def iter_delimited_tables(filename, table_rows=max_table_rows):
+    """
+    Reads a CSV or TSV file in chunks, sniffing its encoding and delimiter from the start of the file.
+
+    Every value is read as text, so identifiers and numbers are reproduced as written. Rows with more fields
+    than the header are skipped with a warning rather than failing the whole file.
+
+    Args:
+        filename: The path of the delimited text file.
+        table_rows: The maximum number of rows in each table.
+
+    Yields:
+        A Pandas DataFrame of up to table_rows rows, each with the file's column headings.
+    """
+    with open(filename, "rb") as f_in:
+        sample = f_in.read(sniff_sample_size)
+    encoding = sniff_encoding(sample)
+    sample_text = codecs.getincrementaldecoder(encoding)(errors="replace").decode(sample, final=False)
+    delimiter = sniff_delimiter(sample_text, filename)
+    with pd.read_csv(filename, sep=delimiter, encoding=encoding, encoding_errors="replace", dtype=str,
+                     chunksize=table_rows, on_bad_lines="warn") as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def iter_spreadsheet_tables(filename):
+    """
+    Reads an Excel file one sheet at a time, opening the workbook only once.
+
+    Excel 2007+ workbooks are read with openpyxl in read-only mode, so rows are parsed as they are consumed.
+    Other workbooks are parsed a sheet at a time from a single pandas ExcelFile. CSV and TSV files are read in
+    chunks of rows, each becoming a table. Each table must be consumed before the next is read.
+
+    Args:
+        filename: The path of the Excel file to be processed.
+
+    Yields:
+        A table per sheet, either a tuple of the column headings and a generator of rows, or a Pandas DataFrame.
+    """
+    if is_delimited_file(filename):
+        yield from iter_delimited_tables(filename)
+    elif zipfile.is_zipfile(filename):
+        workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        try:
+            for worksheet in workbook.worksheets:
+                yield iter_worksheet_rows(worksheet)
+        finally:
+            workbook.close()
+    else:
+        with pd.ExcelFile(filename) as xls:
+            for sheet_name in xls.sheet_names:
+                yield xls.parse(sheet_name)
+
+
 def process_spreadsheet(filename):
     """
     Process an Excel file and extract each sheet as a separate table.
@@ -166,16 +340,12 @@ def process_spreadsheet(filename):
     """
     tables = []
     try:
-        # read the Excel file into a Pandas dataframe
-        xls = pd.ExcelFile(filename)
-
-        # loop through each sheet in the Excel file
-        for sheet_name in xls.sheet_names:
-            # read the sheet into a Pandas dataframe
-            df = pd.read_excel(filename, sheet_name=sheet_name)
-
-            # add the dataframe to the list of tables
-            tables.append(df)
+        if is_delimited_file(filename):
+            return list(iter_delimited_tables(filename))
+        # read each sheet from the open workbook into a Pandas dataframe
+        with pd.ExcelFile(filename) as xls:
+            for sheet_name in xls.sheet_names:
+                tables.append(xls.parse(sheet_name))
     except Exception as ex:
         logging.error(msg=F"The following error was raised processing {filename}: {ex}")
 
@@ -183,6 +353,46 @@ def process_spreadsheet(filename):
     return tables
 
 
+def write_spreadsheet_bioc(filename, output_path, textsource="Auto-CORPus"):
+    """
+    Converts each sheet of an Excel file into a BioC table, writing it to the output file before reading the next.
+
+    The output file is only created once the first sheet has been read, and matches the layout of
+    json.dump(get_tables_bioc(...), indent=4).
+
+    Args:
+        filename: The path of the Excel file to be processed.
+        output_path: The path of the BioC JSON file to write.
+        textsource: Source of the text content.
+
+    Returns:
+        The number of tables written.
+    """
+    table_count = 0
+    f_out = None
+    try:
+        for table in iter_spreadsheet_tables(filename):
+            if not f_out:
+                f_out = open(output_path, "w+", encoding="utf-8")
+                f_out.write("{\n")
+                for key, value in get_bioc_header().items():
+                    value = textwrap.indent(json.dumps(value, indent=json_indent), " " * json_indent).lstrip()
+                    f_out.write(F"{' ' * json_indent}{json.dumps(key)}: {value},\n")
+                f_out.write(F"{' ' * json_indent}\"documents\": [\n")
+            else:
+                f_out.write(",\n")
+            document = BioCTable(table_count + 1, table, textsource).__dict__
+            f_out.write(textwrap.indent(json.dumps(document, indent=json_indent), " " * json_indent * 2))
+            table_count += 1
+    except Exception as ex:
+        logging.error(msg=F"The following error was raised processing {filename}: {ex}")
+    finally:
+        if f_out:
+            f_out.write(F"\n{' ' * json_indent}]\n}}")
+            f_out.close()
+    return table_count
+
+
 def process_directories(input_directory):
     """
     Process files in a given directory and generate BioC format representations of Excel tables.
@@ -200,13 +410,6 @@ def process_directories(input_directory):
         for file in files_in_parent:
             # Check if the file has an accepted extension
             if [x for x in accepted_extensions if file.endswith(x)]:
-                # Process the spreadsheet and extract tables
-                tables = process_spreadsheet(join(parent, file))
-                # If tables are extracted
-                if tables:
-                    # Create a JSON output file for the extracted tables
-                    with open(F"{os.path.join(parent, 'Excel_tables.json')}", "w+", encoding="utf-8") as f_out:
-                        # Generate BioC format representation of the tables
-                        json_output = get_tables_bioc(tables, join(parent, file))
-                        json.dump(json_output, f_out, indent=4)
+                # Stream the BioC format representation of each sheet to the output file
+                if write_spreadsheet_bioc(join(parent, file), os.path.join(parent, 'Excel_tables.json')):
                     logging.info(F"Output: {os.path.join(parent, 'Excel_tables.json')}")
@@ -0,0 +1,132 @@
+import os
+import zipfile
+
+from FAIRClinicalWorkflow.MovieRemoval import video_extensions, is_video_signature
+
+# Supplementary file types
+WORD = "word"
+PDF = "pdf"
+SPREADSHEET = "spreadsheet"
+IMAGE = "image"
+POWERPOINT = "powerpoint"
+ARCHIVE = "archive"
+VIDEO = "video"
+
+word_extensions = [".doc", ".docx"]
+spreadsheet_extensions = [".csv", ".xls", ".xlsx", ".tsv"]
+image_extensions = [".jpg", ".png", ".jpeg", '.tif', '.tiff']
+powerpoint_extensions = [".pptx"]
+zip_extensions = [".zip", ".7z", ".rar", ".zlib", ".7-zip", ".pzip", ".xz"]
+tar_extensions = [".tgz", ".tar"]
+gzip_extensions = [".gzip", ".gz"]
+archive_extensions = zip_extensions + tar_extensions + gzip_extensions
+
+extension_types = {
+    **{x: WORD for x in word_extensions},
+    ".pdf": PDF,
+    **{x: SPREADSHEET for x in spreadsheet_extensions},
+    **{x: IMAGE for x in image_extensions},
+    **{x: POWERPOINT for x in powerpoint_extensions},
+    **{x: ARCHIVE for x in archive_extensions},
+    **{x: VIDEO for x in video_extensions},
+}
+# Plain text formats have no signature, so are identified by their extension alone
+text_extensions = [".csv", ".tsv"]
+
+# Leading bytes of each format, as (offset, signature, file type)
+signatures = [
+    (0, b"\xff\xd8\xff", IMAGE),
+    (0, b"\x89PNG\r\n\x1a\n", IMAGE),
+    (0, b"II*\x00", IMAGE),
+    (0, b"MM\x00*", IMAGE),
+    (0, b"\x1f\x8b", ARCHIVE),
+    (0, b"7z\xbc\xaf\x27\x1c", ARCHIVE),
+    (0, b"Rar!\x1a\x07", ARCHIVE),
+    (0, b"\xfd7zXZ\x00", ARCHIVE),
+    (257, b"ustar", ARCHIVE),
+]
+pdf_signature = b"%PDF-"
+ole_signature = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+zip_signatures = [b"PK\x03\x04", b"PK\x05\x06"]
+# Office Open XML packages are zip files, identified by the folder holding their main part
+office_folders = {"word/": WORD, "xl/": SPREADSHEET, "ppt/": POWERPOINT}
+# PDF headers may follow a short preamble, so are searched for within the sample once container formats, which may
+# hold an uncompressed PDF near their start, have been ruled out
+sample_size = 1024
+# Legacy Word files are often RTF or HTML documents saved with a .doc extension, which the Word converter can open
+doc_text_signatures = [b"{\\rtf", b"<html", b"<!doctype"]
+
+
+def get_extension_type(file):
+    """
+    Identifies the type of a file from its extension alone.
+
+    Args:
+        file (str): The file name or path.
+
+    Returns:
+        str: The file type, or None if the extension is not recognised.
+    """
+    return extension_types.get(os.path.splitext(str(file))[-1].lower())
+
+
+def __get_zip_type(file):
+    """
+    Distinguishes Office Open XML documents from zip archives by their members.
+
+    Args:
+        file (str): The path to the zip file.
+
+    Returns:
+        str: The document type, or ARCHIVE for any other zip file.
+    """
+    try:
+        with zipfile.ZipFile(file, 'r') as zip_ref:
+            for name in zip_ref.namelist():
+                for folder, file_type in office_folders.items():
+                    if name.startswith(folder):
+                        return file_type
+    except zipfile.BadZipfile:
+        pass
+    return ARCHIVE
+
+
+def detect_file_type(file):
+    """
+    Identifies the type of a file from its magic bytes, falling back to the extension for plain text formats.
+
+    Signatures shared by several formats (OLE compound files and zip packages) are resolved using the extension
+    and the package contents. Files whose contents contradict their extension are identified by their contents,
+    and files of a binary type without a matching signature are not identified at all, except for .doc files
+    holding RTF or HTML.
+
+    Args:
+        file (str): The path to the file.
+
+    Returns:
+        str: The file type, or None if the file is not a supported type.
+    """
+    extension_type = get_extension_type(file)
+    try:
+        with open(file, "rb") as f_in:
+            sample = f_in.read(sample_size)
+    except IOError:
+        return None
+    if sample.startswith(ole_signature):
+        # legacy Word, Excel and PowerPoint files share the compound file format
+        return extension_type if extension_type in (WORD, SPREADSHEET, POWERPOINT) else None
+    if any([sample.startswith(x) for x in zip_signatures]):
+        return __get_zip_type(file)
+    if is_video_signature(sample):
+        return VIDEO
+    for offset, signature, file_type in signatures:
+        if sample[offset:offset + len(signature)] == signature:
+            return file_type
+    if pdf_signature in sample:
+        return PDF
+    extension = os.path.splitext(str(file))[-1].lower()
+    if extension in text_extensions:
+        return extension_type
+    if extension == ".doc" and any([sample.lstrip().lower().startswith(x) for x in doc_text_signatures]):
+        return WORD
+    return None
@@ -1,31 +1,34 @@
 import datetime
 import io
 import json
+import math
 import os
-from copy import deepcopy
+import string
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join
 from pathlib import Path
 
-# import PyPDF2
+import PyPDF2
 import pandas
 from bioc import BioCCollection
-# import pdfplumber
+import pdfplumber
 import logging
 
 logging.basicConfig(filename="PDFExtractor.log", level=logging.ERROR, format="%(asctime)s - %(levelname)s - %("
                                                                              "message)s")
 
-pdf_data = None
-filename = ""
-table_references = []
-table_locations = {}
-table_count = 0
-
 plumber_config = {
     "vertical_strategy": "text",
     "horizontal_strategy": "lines"
 }
 
+# Text layer quality thresholds, below which a page is treated as scanned or garbled
+min_page_characters = 100
+min_readable_ratio = 0.9
+max_unmapped_glyph_ratio = 0.05
+readable_characters = set(string.ascii_letters + string.digits + string.punctuation)
+
 
 class BioCText:
     def __init__(self, text):
@@ -70,6 +73,7 @@ class BioCText:
             for i in text:
                 for t in i:
                     temp.append(t)
+            text = temp
         text = [x for x in text if x]
         # Iterate through each line in the text
         for line in text:
@@ -423,97 +427,59 @@ def restructure_rows(input_list, column_count):
     return new_rows, new_heading_rows
 
 
-def rotate_page(file, page):
+def get_page_rotation(page):
     """
-    Rotate a specific page of a PDF file and extract tables using pdfplumber.
+    Estimate the orientation of a page's text from the transformation matrices of its characters.
 
     Args:
-        file (str): The path of the input PDF file.
-        page (int): The page number to be rotated and processed.
+        page (pdfplumber.Page): The pdfplumber.Page object representing a single page in a PDF.
 
     Returns:
-        list or bool: If successful, returns the extracted tables as a list.
-                      Otherwise, returns False if an error occurs.
-
-    The function rotates a specific page (`page`) of a PDF file (`file`) and extracts tables using the pdfplumber library.
-
-    It first reads the PDF file using PyPDF2.PdfReader and makes a deepcopy of the desired page using reader.pages[page].
-
-    The function then extracts the text from the page at the initial orientation (0 degrees) and calculates the average line length.
-
-    It performs a loop to rotate the page in 90-degree increments, extract the text, and calculate the average line length for each rotation.
-    The rotation_line_length_counts list keeps track of the average line length for each rotation.
-
-    After the loop, the function determines the final rotation based on the rotation with the maximum average line length.
-    If all rotations have the same average line length, the final rotation is set to 0.
-
-    The function sets new_page to the original page from the reader.
-    If a final_rotation is required, it rotates the new_page accordingly.
-
-    Then, it writes the rotated page to a BytesIO stream using PyPDF2.PdfWriter and PyPDF2.PdfWriter.write().
-
-    If any exception occurs during the writing process, it logs an error message and returns False.
-
-    If the writing process is successful, the function seeks to the beginning of the stream and opens it as a buffered reader.
+        int: The clockwise rotation in degrees (0, 90, 180 or 270) that makes most of the page's text upright.
 
-    It opens the buffered reader with pdfplumber to get a plumber_page object.
-
-    The function extracts tables from the plumber_page using pdfplumber.Page.extract_tables() and the best plumber configuration
-    obtained from get_best_plumber_config().
-
-    Finally, it returns the extracted tables as a list if successful or False if an error occurs.
+    Each character's matrix (a, b, c, d, e, f) gives the direction of its baseline as atan2(b, a). The direction of
+    every character is rounded to the nearest multiple of 90 degrees and the most common direction is returned,
+    so a single pass over the characters replaces extracting the page's text at each orientation.
+    If the matrices are unavailable, the direction is taken from the displacement between consecutive characters
+    of the same size instead.
     """
-    reader = PyPDF2.PdfReader(file)
-    new_page = deepcopy(reader.pages[page])
-    # Extract text from the page at the initial orientation (0 degrees)
-    page_text = new_page.extract_text(orientations=(0)).split("\n")
-    avg_line_length = sum(len(s) for s in page_text) / len(page_text) if len(page_text) > 0 else 0
-    rotation_count = 0
-    rotation_line_length_counts = [avg_line_length]
-
-    # Rotate the page in 90-degree increments and calculate average line length for each rotation
-    while rotation_count < 3:
-        page_text = new_page.extract_text(orientations=(90 * (rotation_count + 1))).split("\n")
-        avg_line_length = sum(len(s) for s in page_text) / len(page_text) if len(page_text) > 0 else 0
-        rotation_line_length_counts.append(avg_line_length)
-        rotation_count += 1
-
-    # Determine the final rotation based on the rotation with the maximum average line length
-    if len(set(rotation_line_length_counts)) > 1:
-        final_rotation = (rotation_line_length_counts.index(max(rotation_line_length_counts))) * 90
-    else:
-        final_rotation = 0
-
-    new_page = reader.pages[page]
-
-    # Rotate the new_page if a final rotation is required
-    if final_rotation:
-        new_page.rotate(final_rotation)
-    with io.BytesIO() as stream:
-        try:
-            # Write the rotated page to the stream
-            writer = PyPDF2.PdfWriter(stream)
-            writer.add_page(new_page)
-            writer.write(stream)
-        except AssertionError as ae:
-            logging.error(msg=F"{file} raised the following error: {ae}")
-            return False
-        except Exception as ex:
-            logging.error(msg=F"{file} raised the following error: {ex}")
-            return False
-
-        # Seek to the beginning of the stream and open it as a buffered reader
-        stream.seek(0)
-        reader = io.BufferedReader(stream)
+    rotation_counts = Counter()
+    previous = None
+    for char in page.chars:
+        matrix = char.get("matrix")
+        if matrix:
+            if not matrix[0] and not matrix[1]:
+                continue
+            rotation_counts[round(math.degrees(math.atan2(matrix[1], matrix[0])) / 90) % 4 * 90] += 1
+        elif previous and previous["size"] == char["size"]:
+            rotation = get_char_direction(previous, char)
+            if rotation is not None:
+                rotation_counts[rotation] += 1
+        previous = char
+    return rotation_counts.most_common(1)[0][0] if rotation_counts else 0
+
+
+def get_char_direction(previous, char):
+    """
+    Estimate the direction of text from two consecutive characters, for PDFs read without character matrices.
 
-        # Open the buffered reader with pdfplumber
-        plumber_page = pdfplumber.open(reader)
-        new_page = plumber_page.pages[0]
+    Args:
+        previous (dict): The preceding pdfplumber character.
+        char (dict): The following pdfplumber character.
 
-        # Extract tables from the plumber_page using the best plumber configuration
-        data = None
-        data = new_page.extract_tables(table_settings=get_best_plumber_config(new_page))
-        return data if data else False
+    Returns:
+        int: The rotation in degrees, on the same scale as get_page_rotation, or None if the characters are not
+             neighbours on the same line.
+    """
+    dx = (char["x0"] + char["x1"] - previous["x0"] - previous["x1"]) / 2
+    dy = (char["top"] + char["bottom"] - previous["top"] - previous["bottom"]) / 2
+    # characters further apart than a few widths are on different lines or in different columns
+    if not dx and not dy or max(abs(dx), abs(dy)) > char["size"] * 3:
+        return None
+    if abs(dx) >= abs(dy):
+        return 0 if dx > 0 else 180
+    # page coordinates run downwards, so text read from the bottom up has a counter-clockwise baseline
+    return 270 if dy > 0 else 90
 
 
 def validate_bounding_box(page, bbox):
@@ -563,151 +529,318 @@ def validate_bounding_box(page, bbox):
     return validated_bbox
 
 
-def get_best_plumber_config(page):
+def is_text_layer_usable(page_text):
     """
-    Determine the best configuration for extracting tables using the pdfplumber library.
+    Checks whether the text layer of a page is dense and readable enough to be used without OCR.
 
     Args:
-        page (pdfplumber.Page): The pdfplumber.Page object representing a single page in a PDF.
+        page_text (str): The text extracted from the page's text layer.
 
     Returns:
-        dict: A dictionary containing the best configuration options for extracting tables.
-            - "vertical_strategy" (str): The chosen vertical strategy for table extraction.
-
-    The function takes a pdfplumber.Page object as input, representing a single page in a PDF.
-
-    It first initializes the `new_plumber_config` variable with the initial configuration stored in `plumber_config`.
-
-    The function attempts to find tables on the page using the `find_tables()` method of the `page` object.
-    If tables are found, it performs the following steps:
-    1. Tries to access the first table in the `tables` list.
-    2. Retrieves the bounding box of the table and crops the page to the table area using `page.crop()`.
-       If a ValueError is raised (which can occur if the table's bounding box is larger than the actual page),
-       the function sets the `table_area` to the entire page.
-    3. If any other exception occurs, it logs an error message and continues execution.
-    4. Extracts the text from the `table_area` using `table_area.extract_text()`.
-    5. Calculates the average number of spaces per line in the extracted text.
-    6. Determines the number of vertical and horizontal edges in the `table_area`.
-    7. Based on the comparison of vertical edges and the average space count,
-       it updates the "vertical_strategy" in `new_plumber_config` to either "text" or "lines".
-
-    Finally, the function returns the `new_plumber_config` dictionary containing the best configuration options for table extraction.
-    """
-    table_area = None
-    new_plumber_config = plumber_config
-    # Find tables on the page
-    tables = []
-    try:
-        tables = page.find_tables()
-    except:
-        return plumber_config
-    if tables:
+        bool: True if the text layer is usable, False if the page is likely scanned or its fonts garbled.
+    """
+    if not page_text:
+        return False
+    characters = "".join(page_text.split())
+    if len(characters) < min_page_characters:
+        return False
+    # glyphs without a unicode mapping are extracted as (cid:n)
+    if page_text.count("(cid:") * len("(cid:0)") / len(characters) > max_unmapped_glyph_ratio:
+        return False
+    readable = sum([1 for x in characters if x in readable_characters or x.isalnum()])
+    return readable / len(characters) >= min_readable_ratio
+
+
+def get_usable_text_pages(pdf, pages=None):
+    """
+    Assesses the text layer of each page of an open PDF file.
+
+    Args:
+        pdf (pdfplumber.PDF): The open PDF file.
+        pages (range, optional): Indexes of the pages to assess. Defaults to all pages.
+
+    Returns:
+        list: A boolean for each assessed page, True if the page's text layer is usable.
+    """
+    pages = pages if pages is not None else range(len(pdf.pages))
+    return [is_text_layer_usable(pdf.pages[i].extract_text()) for i in pages]
+
+
+class PdfTableExtractor:
+    """
+    Extracts tables and page texts from PDF files.
+
+    The extractor holds no state shared between calls, so a single instance can process many files concurrently.
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(config if config else plumber_config)
+
+    def get_best_config(self, page):
+        """
+        Determine the best configuration for extracting tables using the pdfplumber library.
+
+        Args:
+            page (pdfplumber.Page): The pdfplumber.Page object representing a single page in a PDF.
+
+        Returns:
+            dict: A dictionary containing the best configuration options for extracting tables.
+                - "vertical_strategy" (str): The chosen vertical strategy for table extraction.
+
+        The function takes a pdfplumber.Page object as input, representing a single page in a PDF.
+
+        It first initializes the `new_plumber_config` variable with a copy of the extractor's base configuration,
+        which is never modified.
+
+        The function attempts to find tables on the page using the `find_tables()` method of the `page` object.
+        If tables are found, it performs the following steps:
+        1. Tries to access the first table in the `tables` list.
+        2. Retrieves the bounding box of the table and crops the page to the table area using `page.crop()`.
+           If a ValueError is raised (which can occur if the table's bounding box is larger than the actual page),
+           the function sets the `table_area` to the entire page.
+        3. If any other exception occurs, it logs an error message and also uses the entire page.
+        4. Extracts the text from the `table_area` using `table_area.extract_text()`.
+        5. Calculates the average number of spaces per line in the extracted text.
+        6. Determines the number of vertical and horizontal edges in the `table_area`.
+        7. Based on the comparison of vertical edges and the average space count,
+           it updates the "vertical_strategy" in `new_plumber_config` to either "text" or "lines".
+
+        Finally, the function returns the `new_plumber_config` dictionary containing the best configuration options for table extraction.
+        """
+        table_area = None
+        new_plumber_config = dict(self.config)
+        # Find tables on the page
+        tables = []
         try:
-            # Get the first table and its bounding box
-            table = tables[0]
-            # Table's bounding box can, on rare occasions, be larger than the actual page
-            table_area = page.crop(validate_bounding_box(page, table.bbox))
-        except ValueError as ve:
-            # Table's bounding box can, on rare occasions, be larger than the actual page.
-            table_area = page
+            tables = page.find_tables()
+        except:
+            return new_plumber_config
+        if tables:
+            try:
+                # Get the first table and its bounding box
+                table = tables[0]
+                # Table's bounding box can, on rare occasions, be larger than the actual page
+                table_area = page.crop(validate_bounding_box(page, table.bbox))
+            except ValueError as ve:
+                # Table's bounding box can, on rare occasions, be larger than the actual page.
+                table_area = page
+            except Exception as ex:
+                logging.error(F"The following error was raised searching and scaling table bounding boxes: {ex}")
+                table_area = page
+
+            # Extract text from the table area
+            text_area = table_area.extract_text()
+
+            # Calculate the average number of spaces per line
+            space_counts = [len(x.split(" ")) - 1 for x in text_area.split("\n")]
+            avg_space_count = sum(space_counts) / len(space_counts)
+
+            # Determine the number of vertical and horizontal edges in the table area
+            vertical_edges = len(table_area.vertical_edges)
+            horizontal_edges = len(table_area.horizontal_edges)
+
+            # Update the vertical strategy in new_plumber_config based on the
+            # comparison of vertical edges and average space count
+            if vertical_edges < avg_space_count:
+                new_plumber_config["vertical_strategy"] = "text"
+            else:
+                new_plumber_config["vertical_strategy"] = "lines"
+
+        return new_plumber_config
+
+    def extract_page_tables(self, page):
+        """
+        Extract tables from an open pdfplumber page using the best plumber configuration.
+
+        Args:
+            page (pdfplumber.Page): The pdfplumber.Page object representing a single page in a PDF.
+
+        Returns:
+            list or bool: The extracted tables as a list, or False if no tables were found.
+        """
+        data = page.extract_tables(table_settings=self.get_best_config(page))
+        return data if data else False
+
+    def rotate_page(self, reader, page, rotation, file):
+        """
+        Rotate a specific page of a PDF file and extract tables using pdfplumber.
+
+        Args:
+            reader (PyPDF2.PdfReader): The reader of the input PDF file, shared by all rotated pages of the file.
+            page (int): The page number to be rotated and processed.
+            rotation (int): The clockwise rotation in degrees, as estimated by get_page_rotation.
+            file (str): The path of the input PDF file.
+
+        Returns:
+            list or bool: If successful, returns the extracted tables as a list.
+                          Otherwise, returns False if an error occurs.
+
+        The function rotates the page within the shared reader and writes it to a BytesIO stream using
+        PyPDF2.PdfWriter, which is then opened with pdfplumber so tables are extracted from the upright page.
+        Only rotated pages reach this function; tables on upright pages are extracted from the page already open.
+        """
+        new_page = reader.pages[page]
+        new_page.rotate(rotation)
+        with io.BytesIO() as stream:
+            try:
+                # Write the rotated page to the stream
+                writer = PyPDF2.PdfWriter()
+                writer.add_page(new_page)
+                writer.write(stream)
+            except AssertionError as ae:
+                logging.error(msg=F"{file} raised the following error: {ae}")
+                return False
+            except Exception as ex:
+                logging.error(msg=F"{file} raised the following error: {ex}")
+                return False
+
+            # Seek to the beginning of the stream and open it with pdfplumber
+            stream.seek(0)
+            with pdfplumber.open(stream) as plumber_pdf:
+                return self.extract_page_tables(plumber_pdf.pages[0])
+
+    def process_pdf(self, input_file, pages=None, pdf=None):
+        """
+        Process a PDF file and extract tables and page texts.
+
+        Args:
+            input_file (str): The path of the input PDF file.
+            pages (list, optional): Indexes of the pages to process. Defaults to all pages.
+            pdf (pdfplumber.PDF, optional): The input file, if already open. It is left open for the caller.
+
+        Returns:
+            tuple: A tuple containing tables and page texts.
+                - tables (list): A list of pandas DataFrames representing the extracted tables.
+                - page_texts (list): A list of strings representing the extracted text from each page.
+
+        The function uses the `pdfplumber` library to open the input PDF file.
+
+        It iterates over each page in the PDF file and performs the following steps:
+        1. Extracts the text from the page using `page.extract_text()`.
+        2. Splits the extracted text into lines using the newline character ('\n').
+        3. Estimates the page's orientation with `get_page_rotation`. Tables on upright pages are extracted from the open
+           page, while rotated pages are passed to `rotate_page` with a PyPDF2 reader opened once for the file.
+        4. If tables are extracted, it iterates over each table in the data and performs the following:
+            a. Extracts the column names from the first row of the table.
+            b. Restructures the rows of the table using the `restructure_rows` function.
+            c. If there are missing row data, it raises a ValueError with a message.
+            d. If new headings are present, it appends them to the corresponding columns.
+            e. Constructs a pandas DataFrame using the rows and columns.
+        5. If any exception occurs during the table processing, it logs an error message and returns False for both tables and page texts.
+
+        The extracted tables and page texts are appended to the `tables` and `page_texts` lists, respectively.
+
+        Finally, the function returns the `tables` and `page_texts` lists as a tuple.
+        """
+        opened = pdf is None
+        if opened:
+            pdf = pdfplumber.open(input_file)
+        logging.info(input_file)
+        tables = []
+        page_texts = []
+        # Only opened if the file has rotated pages
+        reader = None
+        # Iterate over each page in the PDF file
+        for i in (pages if pages is not None else range(len(pdf.pages))):
+            page = pdf.pages[i]
+            # Extract text from the page and split into lines
+            page_text = page.extract_text()
+            page_text = page_text.split("\n")
+            # Check if the page needs rotation and perform necessary rotations
+            rotation = get_page_rotation(page)
+            if rotation:
+                if reader is None:
+                    reader = PyPDF2.PdfReader(input_file)
+                data = self.rotate_page(reader, i, rotation, input_file)
+            else:
+                data = self.extract_page_tables(page)
+            if data:
+                for table in data:
+                    try:
+                        # Extract column names from the first row
+                        cols = [x for x in table[0]]
+                        # Restructure rows and get new headings if available
+                        rows, new_headings = restructure_rows(table[1:], len(table[0]))
+                        # Raise an error if there are missing row data
+                        if not rows:
+                            raise ValueError("missing row data")
+                        # Append new headings to the corresponding columns
+                        if new_headings:
+                            for h_idx, heading_row in enumerate(new_headings):
+                                for col_idx in range(len(cols)):
+                                    if col_idx > h_idx:
+                                        break
+                                    if heading_row[col_idx]:
+                                        cols[col_idx] = F"{cols[col_idx]} | {heading_row[col_idx]}"
+                        # Create a pandas DataFrame using the rows and columns
+                        df = pandas.DataFrame(rows, columns=cols)
+                    except ValueError as ve:
+                        logging.error(msg=F"Failed to process table on page {i} of file: {input_file} due to:\n{ve}")
+                        continue
+                    except Exception as ex:
+                        logging.error(msg=F"Failed to process file: {input_file} due to:\n{ex}")
+                        continue
+                    # Append the DataFrame to the tables list
+                    tables.append(df)
+            # Append the page text to the page_texts list
+            page_texts.append(page_text)
+            # Release the page's parsed layout, so memory is bounded by a single page
+            page.flush_cache()
+        if opened:
+            pdf.close()
+        # Return the tables and page_texts as a tuple
+        return tables, page_texts
+
+    def __process_safely(self, input_file):
+        try:
+            return self.process_pdf(input_file)
         except Exception as ex:
-            logging.error(F"The following error was raised searching and scaling table bounding boxes: {ex}")
+            logging.error(msg=F"Failed to process file: {input_file} due to:\n{ex}")
+            return [], []
+
+    def extract_many(self, paths, workers=4):
+        """
+        Extract tables and page texts from many PDF files concurrently on a thread pool.
+
+        Args:
+            paths (list): The paths of the input PDF files.
+            workers (int): The number of files processed at once.
 
-        # Extract text from the table area
-        text_area = table_area.extract_text()
+        Returns:
+            list: A (tables, page_texts) tuple for each file, in the order of the paths.
+                  Files which could not be processed give empty lists.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(self.__process_safely, x) for x in paths]
+            return [future.result() for future in futures]
 
-        # Calculate the average number of spaces per line
-        space_counts = [len(x.split(" ")) - 1 for x in text_area.split("\n")]
-        avg_space_count = sum(space_counts) / len(space_counts)
 
-        # Determine the number of vertical and horizontal edges in the table area
-        vertical_edges = len(table_area.vertical_edges)
-        horizontal_edges = len(table_area.horizontal_edges)
+def get_best_plumber_config(page):
+    """
+    Determine the best configuration for extracting tables from a page, leaving `plumber_config` unchanged.
 
-        # Update the vertical strategy in new_plumber_config based on the
-        # comparison of vertical edges and average space count
-        if vertical_edges < avg_space_count:
-            new_plumber_config["vertical_strategy"] = "text"
-        else:
-            new_plumber_config["vertical_strategy"] = "lines"
+    Args:
+        page (pdfplumber.Page): The pdfplumber.Page object representing a single page in a PDF.
 
-    return new_plumber_config
+    Returns:
+        dict: A new dictionary containing the best configuration options for extracting tables.
+    """
+    return PdfTableExtractor().get_best_config(page)
 
 
-def process_pdf(input_file):
+def process_pdf(input_file, pages=None, pdf=None):
     """
-    Process a PDF file and extract tables and page texts.
+    Process a PDF file and extract tables and page texts with a new PdfTableExtractor.
 
     Args:
         input_file (str): The path of the input PDF file.
+        pages (list, optional): Indexes of the pages to process. Defaults to all pages.
+        pdf (pdfplumber.PDF, optional): The input file, if already open. It is left open for the caller.
 
     Returns:
-        tuple: A tuple containing tables and page texts.
-            - tables (list): A list of pandas DataFrames representing the extracted tables.
-            - page_texts (list): A list of strings representing the extracted text from each page.
-
-    The function uses the `pdfplumber` library to open the input PDF file.
-
-    It iterates over each page in the PDF file and performs the following steps:
-    1. Extracts the text from the page using `page.extract_text()`.
-    2. Splits the extracted text into lines using the newline character ('\n').
-    3. Calls the `rotate_page` function to check if the page needs to be rotated and performs necessary rotations.
-    4. If the `rotate_page` function returns data, it iterates over each table in the data and performs the following:
-        a. Extracts the column names from the first row of the table.
-        b. Restructures the rows of the table using the `restructure_rows` function.
-        c. If there are missing row data, it raises a ValueError with a message.
-        d. If new headings are present, it appends them to the corresponding columns.
-        e. Constructs a pandas DataFrame using the rows and columns.
-    5. If any exception occurs during the table processing, it logs an error message and returns False for both tables and page texts.
-
-    The extracted tables and page texts are appended to the `tables` and `page_texts` lists, respectively.
-
-    Finally, the function returns the `tables` and `page_texts` lists as a tuple.
-    """
-    filename = input_file
-    pdf = pdfplumber.open(input_file)
-    logging.info(input_file)
-    tables = []
-    page_texts = []
-    # Iterate over each page in the PDF file
-    for i, page in enumerate(pdf.pages):
-        # Extract text from the page and split into lines
-        page_text = page.extract_text()
-        page_text = page_text.split("\n")
-        # Check if the page needs rotation and perform necessary rotations
-        data = rotate_page(input_file, i)
-        if data:
-            for table in data:
-                try:
-                    # Extract column names from the first row
-                    cols = [x for x in table[0]]
-                    # Restructure rows and get new headings if available
-                    rows, new_headings = restructure_rows(table[1:], len(table[0]))
-                    # Raise an error if there are missing row data
-                    if not rows:
-                        raise ValueError("missing row data")
-                    # Append new headings to the corresponding columns
-                    if new_headings:
-                        for h_idx, heading_row in enumerate(new_headings):
-                            for i in range(len(cols)):
-                                if i > h_idx:
-                                    break
-                                if heading_row[i]:
-                                    cols[i] = F"{cols[i]} | {heading_row[i]}"
-                    # Create a pandas DataFrame using the rows and columns
-                    df = pandas.DataFrame(rows, columns=cols)
-                except ValueError as ve:
-                    logging.error(msg=F"Failed to process table on page {i} of file: {input_file} due to:\n{ve}")
-                    continue
-                except Exception as ex:
-                    logging.error(msg=F"Failed to process file: {input_file} due to:\n{ex}")
-                    continue
-                # Append the DataFrame to the tables list
-                tables.append(df)
-        # Append the page text to the page_texts list
-        page_texts.append(page_text)
-    # Return the tables and page_texts as a tuple
-    return tables, page_texts
+        tuple: A tuple containing the extracted tables and page texts, as described in PdfTableExtractor.process_pdf.
+    """
+    return PdfTableExtractor().process_pdf(input_file, pages, pdf)
 
 
 def replace_unicode(text):
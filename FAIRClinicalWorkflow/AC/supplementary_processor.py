@@ -4,32 +4,46 @@ import os.path
 import secrets
 import sys
 import tarfile
+import time
 import zipfile
 import PyPDF2
 from os.path import exists
 from pathlib import Path
 
-import marker.utils
+import pdfplumber
 from bioc import biocjson
 
-from FAIRClinicalWorkflow.AC.file_extension_analysis import get_file_extensions, zip_extensions, tar_extensions, \
-    gzip_extensions, search_zip, search_tar, archive_extensions
-from FAIRClinicalWorkflow.AC.pdf_extractor import convert_pdf_result, get_text_bioc
+from FAIRClinicalWorkflow.AC.file_extension_analysis import get_file_extensions, search_zip, search_tar
+from FAIRClinicalWorkflow.AC.file_types import detect_file_type, word_extensions, spreadsheet_extensions, \
+    image_extensions, archive_extensions, WORD, PDF, SPREADSHEET, IMAGE, POWERPOINT, ARCHIVE
+from FAIRClinicalWorkflow.AC.pdf_extractor import convert_pdf_result, get_text_bioc, get_usable_text_pages, process_pdf
 from FAIRClinicalWorkflow.AC.word_extractor import process_word_document
-from FAIRClinicalWorkflow.AC.excel_extractor import process_spreadsheet, get_tables_bioc
+from FAIRClinicalWorkflow.AC.excel_extractor import write_spreadsheet_bioc
 from marker.convert import convert_single_pdf
 from marker.models import load_all_models
 from marker.output import save_markdown
 
+from FAIRClinicalWorkflow.DownloadManifest import get_file_checksum
+from FAIRClinicalWorkflow.ExtractionCache import ExtractionCache
 from FAIRClinicalWorkflow.MovieRemoval import log_unprocessed_supplementary_file
-from FAIRClinicalWorkflow.image_extractor import get_ocr_results, get_sibils_ocr
+from FAIRClinicalWorkflow.image_extractor import get_ocr_results, get_default_client, get_sibils_id, sibils_url
 from FAIRClinicalWorkflow.powerpoint_extractor import get_powerpoint_text
 
-word_extensions = [".doc", ".docx"]
-spreadsheet_extensions = [".csv", ".xls", ".xlsx", ".tsv"]
-image_extensions = [".jpg", ".png", ".jpeg", '.tif', '.tiff']
 supplementary_types = word_extensions + spreadsheet_extensions + image_extensions + [".pdf", ".pptx"]
 model_list = []
+# Multiplier of marker's model batch sizes, so more pages are run through the surya models at once at the cost of
+# more memory per PDF worker
+pdf_batch_multiplier = 1
+# Number of pages extracted at a time, bounding the memory used by large PDFs
+pdf_window_pages = 20
+# Per-file record of how each PDF's pages were extracted
+pdf_metrics_path = "PDF_extraction_metrics.tsv"
+# Output files written for each supplementary file
+result_suffixes = ["_bioc.json", "_tables.json"]
+# Version of each extractor's output, to be increased whenever it changes so cached results are not reused.
+# Archives are not cached as a whole, as each of their members is cached instead.
+extractor_versions = {WORD: 1, PDF: 1, POWERPOINT: 1, SPREADSHEET: 1, IMAGE: 1}
+result_cache = None
 
 
 def load_models():
@@ -38,6 +52,18 @@ def load_models():
         model_list = load_all_models()
 
 
+def initialise_pdf_worker(batch_multiplier=1):
+    """
+    Process pool initializer loading the marker models once per worker, before any PDF is received.
+
+    Args:
+        batch_multiplier (int): The multiplier of marker's model batch sizes used by the worker.
+    """
+    global pdf_batch_multiplier
+    pdf_batch_multiplier = max(1, batch_multiplier)
+    load_models()
+
+
 def __extract_word_data(locations=None, file=None):
     """
     Extracts data from Word documents located at the given file locations.
@@ -150,16 +176,16 @@ def __extract_pdf_data(locations=None, file=None):
         None
 
     """
-    load_models()
     base_dir, file_name = os.path.split(file)
     if locations:
+        load_models()
         pdf_locations = locations[".pdf"]["locations"]
         # Iterate over the file locations of PDF documents
         for x in pdf_locations:
             base_dir, file_name = os.path.split(x)
             # Process the PDF document using a custom pdf_extractor
             text, images, out_meta = convert_single_pdf(fname=x, model_lst=model_list,
-                                                        langs=["English"])
+                                                        langs=["English"], batch_multiplier=pdf_batch_multiplier)
             text, tables = convert_pdf_result([], text, x)
             # Write the extracted tables & texts to JSON files
             # if tables:
@@ -169,41 +195,153 @@ def __extract_pdf_data(locations=None, file=None):
                 with open(F"{os.path.join(base_dir, file_name + '_tables.json')}", "w+", encoding="utf-8") as text_out:
                     biocjson.dump(text, text_out, indent=4)
     if file:
-        try:
-            marker.utils.flush_cuda_memory()
-            # Check the size of the PDF in pages
-            total_pages = 0
-            with open(file, 'rb') as f_in:
-                pdf_reader = PyPDF2.PdfReader(file)
-                total_pages = len(pdf_reader.pages)
-                f_in.close()
-
-            if total_pages > 100:
-                print(F"PDF file contains over 100 pages, skipping: {file}")
-                return False, "PDF file contains over 100 pages. This file was skipped."
-
-            text, images, out_meta = convert_single_pdf(fname=file, model_lst=model_list, langs=["English"])
-            text, tables = extract_table_from_text(text)
-            text, tables = convert_pdf_result(tables, [text], file)
-            if text or tables:
-                base_dir = base_dir.replace("Raw", "Processed")
-                if text:
-                    with open(F"{os.path.join(base_dir, file_name + '_bioc.json')}", "w+",
-                              encoding="utf-8") as text_out:
-                        biocjson.dump(text, text_out, indent=4)
-                if tables:
-                    with open(F"{os.path.join(base_dir, file_name + '_tables.json')}", "w+",
-                              encoding="utf-8") as tables_out:
-                        json.dump(tables, tables_out, indent=4)
-                text, images, out_meta, tables, file = None, None, None, None, None
-                return True, ""
-            else:
-                text, images, out_meta, tables, file = None, None, None, None, None
-                return False, ""
-        except Exception as ex:
-            print(ex)
+        return __convert_pdf(file)
+
+
+def __convert_pdf(file):
+    """
+    Converts a PDF file, writing its text and tables to BioC files in the Processed folder.
+
+    Args:
+        file (str): The path to the PDF file.
+
+    Returns:
+        tuple: Whether any text or tables were extracted, and the reason the file was skipped if it was.
+    """
+    base_dir, file_name = os.path.split(file)
+    try:
+        start_time = time.perf_counter()
+        text, tables, total_pages, marker_pages = __extract_pdf_pages(file)
+        log_pdf_metrics(file, total_pages, marker_pages, time.perf_counter() - start_time)
+        text, tables = convert_pdf_result(tables, text, file)
+        if text or tables:
+            base_dir = base_dir.replace("Raw", "Processed")
+            if text:
+                with open(F"{os.path.join(base_dir, file_name + '_bioc.json')}", "w+",
+                          encoding="utf-8") as text_out:
+                    biocjson.dump(text, text_out, indent=4)
+            if tables:
+                with open(F"{os.path.join(base_dir, file_name + '_tables.json')}", "w+",
+                          encoding="utf-8") as tables_out:
+                    json.dump(tables, tables_out, indent=4)
+            text, images, out_meta, tables, file = None, None, None, None, None
+            return True, ""
+        else:
             text, images, out_meta, tables, file = None, None, None, None, None
             return False, ""
+    except Exception as ex:
+        print(ex)
+        text, images, out_meta, tables, file = None, None, None, None, None
+        return False, ""
+
+
+def get_page_ranges(usable_pages):
+    """
+    Groups consecutive pages by whether their text layer is usable.
+
+    Args:
+        usable_pages (list): A boolean for each page, True if the page's text layer is usable.
+
+    Returns:
+        list: List of (usable, first page index, page count) tuples, in page order.
+    """
+    page_ranges = []
+    for i, usable in enumerate(usable_pages):
+        if page_ranges and page_ranges[-1][0] == usable:
+            page_ranges[-1] = (usable, page_ranges[-1][1], page_ranges[-1][2] + 1)
+        else:
+            page_ranges.append((usable, i, 1))
+    return page_ranges
+
+
+def __extract_pdf_range(file, pdf, usable, start_page, page_count):
+    """
+    Extracts the text and tables of a run of pages, from the text layer if usable or with marker otherwise.
+
+    Args:
+        file (str): The path to the PDF file.
+        pdf (pdfplumber.PDF): The open PDF file, or None if it could not be opened.
+        usable (bool): Whether the text layer of the pages is usable.
+        start_page (int): The index of the first page, or None for the whole file.
+        page_count (int): The number of pages, or None for the whole file.
+
+    Returns:
+        tuple: The page texts and tables of the run, in page order.
+    """
+    if usable:
+        tables, page_texts = process_pdf(file, range(start_page, start_page + page_count), pdf)
+        # pages are returned as lists of lines, while marker returns a string for each run of pages
+        return ["\n".join(x) for x in page_texts], tables
+    load_models()
+    text, images, out_meta = convert_single_pdf(fname=file, model_lst=model_list, start_page=start_page,
+                                                max_pages=page_count, langs=["English"],
+                                                batch_multiplier=pdf_batch_multiplier)
+    text, tables = extract_table_from_text(text)
+    return [text], tables
+
+
+def __extract_pdf_pages(file):
+    """
+    Extracts the text and tables of a PDF file, using its text layer where it is usable and marker elsewhere.
+
+    The file is opened once, its page count taken from the same reader, and processed in windows of pages so memory
+    stays bounded for large files. Within each window, pages with a dense, readable text layer are parsed directly
+    with pdfplumber, and runs of scanned or garbled pages are converted with the marker models, which are only
+    loaded if such pages exist.
+
+    Args:
+        file (str): The path to the PDF file.
+
+    Returns:
+        tuple: The page texts and tables in page order, the number of pages and the number converted with marker.
+    """
+    texts, tables = [], []
+    try:
+        pdf = pdfplumber.open(file)
+    except Exception as ex:
+        print(F"Unable to read the text layer of {file}, converting it with marker: {ex}")
+        texts, tables = __extract_pdf_range(file, None, False, None, None)
+        return texts, tables, 0, None
+    with pdf:
+        total_pages = len(pdf.pages)
+        marker_pages = 0
+        for window_start in range(0, total_pages, pdf_window_pages):
+            window = range(window_start, min(window_start + pdf_window_pages, total_pages))
+            usable_pages = get_usable_text_pages(pdf, window)
+            marker_pages += usable_pages.count(False)
+            for usable, start_page, page_count in get_page_ranges(usable_pages):
+                range_texts, range_tables = __extract_pdf_range(file, pdf, usable, window_start + start_page,
+                                                                page_count)
+                texts.extend(range_texts)
+                tables.extend(range_tables)
+            for i in window:
+                pdf.pages[i].flush_cache()
+    return texts, tables, total_pages, marker_pages
+
+
+def log_pdf_metrics(file, total_pages, marker_pages, seconds):
+    """
+    Records which extraction path was used for a PDF file.
+
+    Args:
+        file (str): The path to the PDF file.
+        total_pages (int): The number of pages in the file.
+        marker_pages (int): The number of pages converted with marker, or None if the whole file was.
+        seconds (float): The time taken to extract the file.
+
+    Returns:
+        None
+    """
+    if marker_pages is None:
+        extraction_path = "marker"
+    elif not marker_pages:
+        extraction_path = "text layer"
+    else:
+        extraction_path = "marker" if marker_pages == total_pages else "mixed"
+    marker_pages = total_pages if marker_pages is None else marker_pages
+    with open(pdf_metrics_path, "a", encoding="utf-8") as f_out:
+        f_out.write(F"{file}\t{total_pages}\t{total_pages - marker_pages}\t{marker_pages}\t{extraction_path}\t"
+                    F"{seconds:.3f}\n")
 
 
 def __extract_spreadsheet_data(locations=None, file=None):
@@ -228,29 +366,15 @@ def __extract_spreadsheet_data(locations=None, file=None):
         # Iterate over the file locations of Spreadsheet documents
         for x in spreadsheet_locations:
             base_dir, file_name = os.path.split(x)
-            # Process the PDF document using a custom excel_extractor
-            tables = process_spreadsheet(x)
-            # If tables are extracted
-            if tables:
-                # Create a JSON output file for the extracted tables
-                with open(F"{os.path.join(base_dir, file_name + '_tables.json')}", "w+", encoding="utf-8") as f_out:
-                    # Generate BioC format representation of the tables
-                    json_output = get_tables_bioc(tables, x)
-                    json.dump(json_output, f_out, indent=4)
+            # Stream each sheet to the JSON output file using a custom excel_extractor
+            tables = write_spreadsheet_bioc(x, F"{os.path.join(base_dir, file_name + '_tables.json')}")
         if tables:
             return True
     if file:
         base_dir, file_name = os.path.split(file)
-        # Process the PDF document using a custom excel_extractor
-        tables = process_spreadsheet(file)
-        # If tables are extracted
-        if tables:
-            base_dir = base_dir.replace("Raw", "Processed")
-            # Create a JSON output file for the extracted tables
-            with open(F"{os.path.join(base_dir, file_name + '_tables.json')}", "w+", encoding="utf-8") as f_out:
-                # Generate BioC format representation of the tables
-                json_output = get_tables_bioc(tables, file)
-                json.dump(json_output, f_out, indent=4)
+        base_dir = base_dir.replace("Raw", "Processed")
+        # Stream each sheet to the JSON output file using a custom excel_extractor
+        if write_spreadsheet_bioc(file, F"{os.path.join(base_dir, file_name + '_tables.json')}"):
             return True
     return False
 
@@ -289,24 +413,69 @@ def __extract_image_data(locations=None, file=None, pmcid=None):
         if text:
             return True
     if file:
-        base_dir, file_name = os.path.split(file)
-        # Process the PDF document using a custom excel_extractor
-        text, url, reason = get_sibils_ocr(file, pmcid)
-        if not text:
-            text, url, reason = get_ocr_results(file)
-        # If tables are extracted
-        if text:
-            base_dir = base_dir.replace("Raw", "Processed")
-            # Create a JSON output file for the extracted tables
-            with open(F"{os.path.join(base_dir, file_name + '_bioc.json')}", "w+", encoding="utf-8") as f_out:
-                # Generate BioC format representation of the tables
-                json_output = get_text_bioc(text, file, url)
-                json.dump(json_output, f_out, indent=4)
-            return True, reason
-        return False, reason
+        return __get_image_results([file], pmcid)[0][:2]
     return False, ""
 
 
+def __write_image_text(file, text, url):
+    """
+    Writes the text retrieved for an image as a BioC JSON file in the processed directory.
+
+    Args:
+        file (str): The path of the image file.
+        text: The text paragraphs or BioC document retrieved for the image.
+        url (str): The source of the text.
+
+    Returns:
+        None
+    """
+    base_dir, file_name = os.path.split(file)
+    base_dir = base_dir.replace("Raw", "Processed")
+    with open(F"{os.path.join(base_dir, file_name + '_bioc.json')}", "w+", encoding="utf-8") as f_out:
+        json_output = get_text_bioc(text, file, url)
+        json.dump(json_output, f_out, indent=4)
+
+
+def __get_image_results(files, pmcid=None):
+    results = []
+    for file, (text, url, reason) in zip(files, get_default_client().get_image_texts(files, pmcid)):
+        if text:
+            __write_image_text(file, text, url)
+        results.append((bool(text), reason, url))
+    return results
+
+
+def process_image_batch(files, pmcid=None):
+    """
+    Extracts the text of the images of one article, requesting OCR results for them concurrently.
+
+    Images identical to one processed before with the same OCR backend have their outputs restored from the result
+    cache instead, unless SIBiLS holds a document for the image in this article. SIBiLS documents belong to one
+    article, so they are never cached by content.
+
+    Args:
+        files (list): The paths of the image files.
+        pmcid (str): The PMC ID of the article the images belong to.
+
+    Returns:
+        list: A (success, reason) tuple for each file, in the order of the files.
+    """
+    results = {}
+    keys = {file: get_result_key(file, IMAGE) for file in files}
+    sibils_cache = get_default_client().cache
+    for file in files:
+        if sibils_cache and sibils_cache.get(get_sibils_id(file, pmcid))[1]:
+            continue
+        if restore_cached_results(file, keys[file]):
+            results[file] = (True, "")
+    pending_files = [x for x in files if x not in results]
+    for file, (success, reason, url) in zip(pending_files, __get_image_results(pending_files, pmcid)):
+        if success and not (url and url.startswith(sibils_url)):
+            store_results(file, keys[file])
+        results[file] = (success, reason)
+    return [results[x] for x in files]
+
+
 def __extract_powerpoint_data(locations=None, file=None):
     """
     Extracts data from Powerpoint documents located at the given file locations.
@@ -438,20 +607,180 @@ def process_archive_file(locations=None, file=None):
     if locations:
         pass
     elif file:
-        base_dir, file_name = os.path.split(file)
-        extensions = {}
-        file_extension = file[file.rfind('.'):].lower()
-        if file_extension in zip_extensions:
+        # archives are opened by their contents, as their extensions are unreliable
+        if zipfile.is_zipfile(file):
             success, failed_files = process_and_update_zip(file)
-        elif file_extension in tar_extensions or file_extension in gzip_extensions:
+        elif tarfile.is_tarfile(file):
             success, failed_files = process_and_update_tar(file)
     return success, failed_files
 
 
+def __process_word_file(file, pmcid=None):
+    return __extract_word_data(file=file), [], ""
+
+
+def __process_pdf_file(file, pmcid=None):
+    success, reason = __extract_pdf_data(file=file)
+    return success, [], reason
+
+
+def __process_powerpoint_file(file, pmcid=None):
+    return __extract_powerpoint_data(file=file), [], ""
+
+
+def __process_spreadsheet_file(file, pmcid=None):
+    return __extract_spreadsheet_data(file=file), [], ""
+
+
+def __process_image_file(file, pmcid=None):
+    # images are cached by process_image_batch, which knows whether their text came from SIBiLS
+    success, reason = process_image_batch([file], pmcid)[0]
+    return success, [], reason
+
+
+def __process_archive_file(file, pmcid=None):
+    success, failed_files = process_archive_file(file=file)
+    return success, failed_files, ""
+
+
+# Extractors for each detected file type, returning (success, failed archived files, reason)
+extractors = {
+    WORD: __process_word_file,
+    PDF: __process_pdf_file,
+    POWERPOINT: __process_powerpoint_file,
+    SPREADSHEET: __process_spreadsheet_file,
+    IMAGE: __process_image_file,
+    ARCHIVE: __process_archive_file,
+}
+
+
+def get_result_cache():
+    """
+    Opens the extraction result cache shared by this process on first use.
+
+    Returns:
+        ExtractionCache: The result cache.
+    """
+    global result_cache
+    if result_cache is None:
+        result_cache = ExtractionCache()
+    return result_cache
+
+
+def get_output_path(file, suffix):
+    """
+    Builds the path of an output file written for a supplementary file.
+
+    Args:
+        file (str): The path of the supplementary file.
+        suffix (str): The suffix of the output file, such as "_bioc.json".
+
+    Returns:
+        str: The output path, in the processed directory if the file is in a raw directory.
+    """
+    base_dir, file_name = os.path.split(file)
+    return os.path.join(base_dir.replace("Raw", "Processed"), file_name + suffix)
+
+
+def __get_input_file_forms(file):
+    # the forms of a file path used as the "inputfile" of BioC documents
+    return [str(file), str(Path(*Path(file).parts[2:])) if len(Path(file).parts) > 2 else str(file)]
+
+
+def __patch_input_file(data, source, file):
+    """
+    Replaces references to the file a cached output was produced from with the file being processed.
+
+    Args:
+        data: The parsed output file contents.
+        source (str): The path of the file the output was produced from.
+        file (str): The path of the file being processed.
+
+    Returns:
+        The output file contents, updated in place.
+    """
+    replacements = dict(zip(__get_input_file_forms(source), __get_input_file_forms(file)))
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key == "inputfile" and isinstance(value, str):
+                data[key] = replacements.get(value, value)
+            else:
+                __patch_input_file(value, source, file)
+    elif isinstance(data, list):
+        for value in data:
+            __patch_input_file(value, source, file)
+    return data
+
+
+def get_result_key(file, file_type):
+    """
+    Builds the result cache key of a supplementary file from its contents and the version of its extractor.
+
+    Args:
+        file (str): The path of the supplementary file.
+        file_type (str): The detected type of the file.
+
+    Returns:
+        str: The cache key.
+    """
+    extractor = file_type
+    if file_type == IMAGE:
+        # OCR backends give different texts for the same image
+        extractor = F"{IMAGE}-{get_default_client().backend}"
+    return ExtractionCache.get_key(get_file_checksum(file), extractor, extractor_versions[file_type])
+
+
+def restore_cached_results(file, key):
+    """
+    Writes the cached outputs of a supplementary file, if an identical file has been processed before.
+
+    Args:
+        file (str): The path of the supplementary file.
+        key (str): The cache key of the file.
+
+    Returns:
+        bool: True if cached outputs were written, otherwise False.
+    """
+    cached = get_result_cache().get(key)
+    if not cached:
+        return False
+    source, outputs = cached
+    for suffix, contents in outputs.items():
+        if source != file:
+            contents = json.dumps(__patch_input_file(json.loads(contents), source, file), indent=4)
+        with open(get_output_path(file, suffix), "w+", encoding="utf-8") as f_out:
+            f_out.write(contents)
+    return True
+
+
+def store_results(file, key):
+    """
+    Caches the outputs written for a supplementary file.
+
+    Args:
+        file (str): The path of the supplementary file.
+        key (str): The cache key of the file.
+
+    Returns:
+        None
+    """
+    outputs = {}
+    for suffix in result_suffixes:
+        if os.path.exists(get_output_path(file, suffix)):
+            with open(get_output_path(file, suffix), "r", encoding="utf-8") as f_in:
+                outputs[suffix] = f_in.read()
+    if outputs:
+        get_result_cache().store(key, file, outputs)
+
+
 def process_supplementary_files(supplementary_files, output_format='json', pmcid=None):
     """
     Processes input list of file paths as supplementary data.
 
+    Each file is sent to the extractor of the type detected from its contents, so mislabelled files are not passed
+    to the wrong converter. Files identical to one processed before by the same extractor version have their
+    outputs restored from the result cache instead.
+
     Args:
         supplementary_files (list): List of file paths
     """
@@ -460,28 +789,21 @@ def process_supplementary_files(supplementary_files, output_format='json', pmcid
         gc.collect()
         if not os.path.exists(file) or os.path.isdir(file):
             success = False
+            continue
 
-        # Extract data from Word files if they are present
-        if [1 for x in word_extensions if file.lower().endswith(x)]:
-            success = __extract_word_data(file=file)
-
-        # Extract data from PDF files if they are present
-        elif file.lower().endswith("pdf"):
-            success, reason = __extract_pdf_data(file=file)
-
-        # Extract data from PowerPoint files if they are present
-        elif file.lower().endswith("pptx"):
-            success = __extract_powerpoint_data(file=file)
-
-        # Extract data from spreadsheet files if they are present
-        elif [1 for x in spreadsheet_extensions if file.lower().endswith(x)]:
-            success = __extract_spreadsheet_data(file=file)
-
-        elif [1 for x in image_extensions if file.lower().endswith(x)]:
-            success, reason = __extract_image_data(file=file, pmcid=pmcid)
-
-        elif [1 for x in archive_extensions if file.lower().endswith(x)]:
-            success, failed_files = process_archive_file(file=file)
+        file_type = detect_file_type(file)
+        extractor = extractors.get(file_type)
+        if not extractor:
+            continue
+        key = None
+        if file_type in extractor_versions and file_type != IMAGE:
+            key = get_result_key(file, file_type)
+            if restore_cached_results(file, key):
+                success, failed_files, reason = True, [], ""
+                continue
+        success, failed_files, reason = extractor(file, pmcid)
+        if success and key:
+            store_results(file, key)
     return success, failed_files, reason
 
 
@@ -2,15 +2,45 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
-from operator import itemgetter
 from pathlib import Path
 
 import cv2
+import numpy as np
 import pytesseract
+from pytesseract import Output
 
 
 class TableImage:
 
+    def row2text(self, img, row):
+        """
+        Function: translate a row of Table cells into texts with a single tesseract call
+        Input: original image, and locations of the row's text boxes as an array of (x, y, w, h), sorted by x
+        Output: extracted texts of each cell
+        """
+
+        x, y, w, h = row[:, 0], row[:, 1], row[:, 2], row[:, 3]
+        # the same margins as a single cell, around the whole row
+        left, top = max(int(x.min()) - 3, 0), max(int(y.min()) - 3, 0)
+        roi = img[top:int((y + h).max()) + 6, left:int((x + w).max()) + 6]
+        data = pytesseract.image_to_data(roi, lang=self.trainedData, config='--psm 6 --oem 3',
+                                         output_type=Output.DICT)
+        # word centres, in the coordinates of the whole image
+        words = [(data["left"][i] + data["width"][i] / 2 + left, data["top"][i] + data["height"][i] / 2 + top,
+                  data["text"][i].strip()) for i in range(len(data["text"])) if data["text"][i].strip()]
+        texts = [[] for i in range(len(row))]
+        if words:
+            # each word goes to the cell containing its centre. A cell spanning several rows makes the crop
+            # include parts of the next row, whose words fall outside every cell of this row and are dropped.
+            centres = np.array([(centre_x, centre_y) for centre_x, centre_y, text in words])
+            inside = (centres[:, :1] >= x[None, :]) & (centres[:, :1] <= (x + w)[None, :]) & \
+                     (centres[:, 1:] >= y[None, :]) & (centres[:, 1:] <= (y + h)[None, :])
+            # words are in reading order, so each cell's words stay in order across its lines
+            for (centre_x, centre_y, text), in_cells in zip(words, inside):
+                if in_cells.any():
+                    texts[int(in_cells.argmax())].append(text)
+        return [" ".join(cell) for cell in texts]
+
     def img2text(self, img, x, y, w, h):
         """
         Function: translate image into texts
@@ -65,7 +95,7 @@ class TableImage:
         """
         Function: find cells in Table images and sort them from top-left to bottom-right
         Input: original image
-        Output: ordered Table cells, and processed image
+        Output: ordered Table cells as an array of (x, y, w, h), and processed image
         """
 
         added = cv2.copyMakeBorder(img, 10, 10, 10, 10, cv2.BORDER_CONSTANT, value=[255, 255, 255])
@@ -93,27 +123,23 @@ class TableImage:
         thresh = cv2.copyMakeBorder(thresh, 10, 10, 10, 10, cv2.BORDER_CONSTANT, value=[255, 255, 255])
         contours, hierarchy = cv2.findContours(eroded, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
-        # 'cells' save the location and sort
-        cells = []
-        for c in contours:
-            x, y, w, h = cv2.boundingRect(c)
-            # case 1：eliminate rectangles that are too thin (might be lines)
-            if w > h * 20 or h > w * 20:
-                continue
-            # case 2：remove a box similar to the whole image
-            if (w > size[1] * 0.8) and (h > size[0] * 0.8):
-                continue
-
-            # case 3: eliminate small boxes that could be noises
-            area = cv2.contourArea(c)
-            # method 1: constant area. Does not work on images that are too large or too small
-            if area < 250:
-                continue
-
-            cells.append((x, y, w, h))
-
-        # To avoid location errors in one line
-        cells = sorted(cells, key=itemgetter(1, 0))
+        # 'cells' save the location (x, y, w, h) of each box and sort
+        if not contours:
+            return np.empty((0, 4), dtype=int), added, thresh
+        boxes = np.array([cv2.boundingRect(c) for c in contours])
+        areas = np.array([cv2.contourArea(c) for c in contours])
+        w, h = boxes[:, 2], boxes[:, 3]
+        # case 1：eliminate rectangles that are too thin (might be lines)
+        keep = (w <= h * 20) & (h <= w * 20)
+        # case 2：remove a box similar to the whole image
+        keep &= ~((w > size[1] * 0.8) & (h > size[0] * 0.8))
+        # case 3: eliminate small boxes that could be noises
+        # method 1: constant area. Does not work on images that are too large or too small
+        keep &= areas >= 250
+        cells = boxes[keep]
+
+        # To avoid location errors in one line, sort by y then x
+        cells = cells[np.lexsort((cells[:, 0], cells[:, 1]))]
 
         return cells, added, thresh
 
@@ -126,26 +152,15 @@ class TableImage:
 
         # after sort, read cells line by line
         color = (0, 255, 0)  # box color
-        table_row = []
-        row = []
-
-        for (i, (x, y, w, h)) in enumerate(cells):
-            # print(x, y, w, h)
+        for (x, y, w, h) in cells.tolist():
             cv2.rectangle(added, (x, y), (x + w, y + h), color, 1)
-            row.append(cells[i])
-
-            # the last cell, footer or normal cell
-            if i == len(cells) - 1:
-                # save the last line
-                table_row.append(row)
-                break
+        if not len(cells):
+            return []
 
-            # newlines: [i] x+w >[i+1] x // [i+1] y > [i] y+h (latter is used, more accurate)
-            # minus 5 in case two lines are too close
-            if cells[i + 1][1] > cells[i][1] + cells[i][3] - 5:
-                table_row.append(row)
-                # save a new line
-                row = []
+        # newlines: [i] x+w >[i+1] x // [i+1] y > [i] y+h (latter is used, more accurate)
+        # minus 5 in case two lines are too close
+        new_rows = cells[1:, 1] > cells[:-1, 1] + cells[:-1, 3] - 5
+        table_row = np.split(cells, np.flatnonzero(new_rows) + 1)
 
         '''
         # The block (have not fully developed) is used to recognize section names in the left-most column
@@ -179,10 +194,8 @@ class TableImage:
             table_row.append(new_row)
         '''
 
-        for row in table_row:
-            row.sort(key=lambda a: a[0])
-            for (i, (x, y, w, h)) in enumerate(row):
-                row[i] = self.img2text(thresh, x, y, w, h)
+        # one tesseract call per row, rather than per cell
+        table_row = [self.row2text(thresh, row[np.argsort(row[:, 0], kind="stable")]) for row in table_row]
 
         # cv2.imwrite(target_dir + '/' + "{}_result.jpg".format(pmc), added)
 
@@ -0,0 +1,88 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Shared between archives, as articles are revisited whenever an archive is updated
+default_cache_path = os.path.join("Output", "article_page_cache.sqlite")
+
+
+class ArticlePageCache:
+    """
+    On-disk HTTP cache of PMC article pages, keyed by PMCID.
+
+    Only the validators of each page (ETag and Last-Modified) and the supplementary links extracted from it are
+    stored, which is all that is needed to revalidate a page with a conditional request and to reuse its links
+    when the server reports it unchanged.
+    """
+
+    def __init__(self, path=default_cache_path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock, self.__connection:
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    pmcid TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    links TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+
+    def get(self, pmcid):
+        """
+        Retrieve the cached entry of an article page.
+        :param pmcid: PMC ID of the article
+        :return: dictionary of the entry's columns with the links decoded, or None if the page is not cached
+        """
+        with self.__lock:
+            cursor = self.__connection.execute("SELECT * FROM pages WHERE pmcid = ?", (pmcid,))
+            row = cursor.fetchone()
+            columns = [x[0] for x in cursor.description]
+        if not row:
+            return None
+        entry = dict(zip(columns, row))
+        entry["links"] = json.loads(entry["links"])
+        return entry
+
+    def get_conditional_headers(self, pmcid):
+        """
+        Build the request headers used to revalidate a cached article page.
+        :param pmcid: PMC ID of the article
+        :return: dictionary of If-None-Match/If-Modified-Since headers, empty if the page is not cached
+        """
+        entry = self.get(pmcid)
+        conditional_headers = {}
+        if entry:
+            if entry["etag"]:
+                conditional_headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                conditional_headers["If-Modified-Since"] = entry["last_modified"]
+        return conditional_headers
+
+    def store(self, pmcid, url, etag, last_modified, links):
+        """
+        Store the validators and supplementary links of a retrieved article page.
+        :param pmcid: PMC ID of the article
+        :param url: URL of the article page
+        :param etag: ETag response header
+        :param last_modified: Last-Modified response header
+        :param links: list of supplementary link addresses found on the page
+        :return: None
+        """
+        with self.__lock, self.__connection:
+            self.__connection.execute("""
+                INSERT INTO pages (pmcid, url, etag, last_modified, links, updated) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (pmcid) DO UPDATE SET url = excluded.url, etag = excluded.etag,
+                last_modified = excluded.last_modified, links = excluded.links, updated = excluded.updated""",
+                                      (pmcid, url, etag, last_modified, json.dumps(links), time.time()))
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
@@ -0,0 +1,182 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+# Download statuses
+STARTED = "started"
+COMPLETE = "complete"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+# Retry settings for failed downloads
+default_max_attempts = 5
+default_backoff_seconds = 60
+
+
+class DownloadManifest:
+    """
+    Persistent record of supplementary file downloads, keyed by PMCID and URL.
+
+    The manifest is written as each download starts and finishes, so an interrupted run can be resumed:
+    completed downloads are skipped, downloads left in the started state are resumed and failed downloads
+    are retried once their backoff period has passed.
+    """
+
+    def __init__(self, path, max_attempts=default_max_attempts, backoff_seconds=default_backoff_seconds):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock, self.__connection:
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS downloads (
+                    pmcid TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    file_path TEXT,
+                    size INTEGER,
+                    checksum TEXT,
+                    etag TEXT,
+                    last_modified TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL DEFAULT 0,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (pmcid, url)
+                )""")
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS articles (
+                    pmcid TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    updated REAL NOT NULL
+                )""")
+
+    def __execute(self, query, parameters=()):
+        with self.__lock, self.__connection:
+            return self.__connection.execute(query, parameters).fetchall()
+
+    def get(self, pmcid, url):
+        """
+        Retrieve the manifest entry of a download.
+        :param pmcid: PMC ID of the article
+        :param url: download URL
+        :return: dictionary of the entry's columns, or None if the download has not been recorded
+        """
+        with self.__lock:
+            cursor = self.__connection.execute("SELECT * FROM downloads WHERE pmcid = ? AND url = ?", (pmcid, url))
+            row = cursor.fetchone()
+            columns = [x[0] for x in cursor.description]
+        return dict(zip(columns, row)) if row else None
+
+    def should_download(self, pmcid, url):
+        """
+        Check whether a file should be downloaded on this run.
+        :param pmcid: PMC ID of the article
+        :param url: download URL
+        :return: True if the download is new, was interrupted or is a failure due for retry, False otherwise
+        """
+        entry = self.get(pmcid, url)
+        if not entry or entry["status"] == STARTED:
+            return True
+        if entry["status"] == FAILED:
+            return entry["attempts"] < self.max_attempts and entry["next_attempt"] <= time.time()
+        return False
+
+    def record_started(self, pmcid, url, file_path):
+        self.__execute("""
+            INSERT INTO downloads (pmcid, url, status, file_path, updated) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (pmcid, url) DO UPDATE SET status = excluded.status, file_path = excluded.file_path,
+            updated = excluded.updated""", (pmcid, url, STARTED, file_path, time.time()))
+
+    def record_validator(self, pmcid, url, etag=None, last_modified=None):
+        """
+        Record the validators of a download as soon as it receives a response, so an interrupted transfer can be
+        resumed on a later run without mixing two versions of the file.
+        :param pmcid: PMC ID of the article
+        :param url: download URL
+        :param etag: ETag header of the response
+        :param last_modified: Last-Modified header of the response
+        :return: None
+        """
+        self.__execute("UPDATE downloads SET etag = ?, last_modified = ?, updated = ? WHERE pmcid = ? AND url = ?",
+                       (etag, last_modified, time.time(), pmcid, url))
+
+    def record_complete(self, pmcid, url, file_path, size, checksum, etag=None, last_modified=None):
+        self.__execute("""
+            INSERT INTO downloads (pmcid, url, status, file_path, size, checksum, etag, last_modified, attempts, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+            ON CONFLICT (pmcid, url) DO UPDATE SET status = excluded.status, file_path = excluded.file_path,
+            size = excluded.size, checksum = excluded.checksum, etag = excluded.etag,
+            last_modified = excluded.last_modified, attempts = downloads.attempts + 1, updated = excluded.updated""",
+                       (pmcid, url, COMPLETE, file_path, size, checksum, etag, last_modified, time.time()))
+
+    def record_failure(self, pmcid, url):
+        """
+        Record a failed download and schedule its next attempt with an exponential backoff.
+        :param pmcid: PMC ID of the article
+        :param url: download URL
+        :return: None
+        """
+        entry = self.get(pmcid, url)
+        attempts = (entry["attempts"] if entry else 0) + 1
+        next_attempt = time.time() + self.backoff_seconds * 2 ** (attempts - 1)
+        self.__execute("""
+            INSERT INTO downloads (pmcid, url, status, attempts, next_attempt, updated) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (pmcid, url) DO UPDATE SET status = excluded.status, attempts = excluded.attempts,
+            next_attempt = excluded.next_attempt, updated = excluded.updated""",
+                       (pmcid, url, FAILED, attempts, next_attempt, time.time()))
+
+    def record_skipped(self, pmcid, url):
+        self.__execute("""
+            INSERT INTO downloads (pmcid, url, status, updated) VALUES (?, ?, ?, ?)
+            ON CONFLICT (pmcid, url) DO UPDATE SET status = excluded.status, updated = excluded.updated""",
+                       (pmcid, url, SKIPPED, time.time()))
+
+    def article_complete(self, pmcid):
+        """
+        Check whether every supplementary file of an article has been resolved on a previous run.
+        :param pmcid: PMC ID of the article
+        :return: True if the article is complete, False otherwise
+        """
+        rows = self.__execute("SELECT status FROM articles WHERE pmcid = ?", (pmcid,))
+        return bool(rows) and rows[0][0] == COMPLETE
+
+    def record_article(self, pmcid, success=True):
+        """
+        Record the outcome of an article, which is complete once none of its downloads can be retried.
+        :param pmcid: PMC ID of the article
+        :param success: False if the article page could not be retrieved
+        :return: None
+        """
+        status = COMPLETE
+        if not success:
+            status = FAILED
+        else:
+            for download_status, attempts in self.__execute("SELECT status, attempts FROM downloads WHERE pmcid = ?",
+                                                            (pmcid,)):
+                if download_status == STARTED or (download_status == FAILED and attempts < self.max_attempts):
+                    status = FAILED
+                    break
+        self.__execute("""
+            INSERT INTO articles (pmcid, status, updated) VALUES (?, ?, ?)
+            ON CONFLICT (pmcid) DO UPDATE SET status = excluded.status, updated = excluded.updated""",
+                       (pmcid, status, time.time()))
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+def get_file_checksum(file_path):
+    """
+    Calculate the SHA-256 checksum of a file.
+    :param file_path: path to the file
+    :return: hexadecimal checksum
+    """
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as f_in:
+        for chunk in iter(lambda: f_in.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
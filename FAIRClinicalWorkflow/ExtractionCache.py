@@ -0,0 +1,99 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# Shared between archives and worker processes, as supplementary files recur across articles and archive updates
+default_cache_path = os.path.join("Output", "extraction_cache.sqlite")
+# Total compressed size of the cached outputs, beyond which the least recently used entries are evicted
+default_max_size = 2 * 1024 ** 3
+
+
+class ExtractionCache:
+    """
+    Content-addressed on-disk cache of supplementary file extraction outputs.
+
+    Entries are keyed by the SHA-256 checksum of the input file together with the extractor and its version, so
+    identical files are only extracted once and outputs are invalidated whenever an extractor changes. Each entry
+    holds the compressed contents of every output file produced, by output suffix.
+    """
+
+    def __init__(self, path=default_cache_path, max_size=default_max_size):
+        self.path = path
+        self.max_size = max_size
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.__lock, self.__connection:
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    source TEXT NOT NULL,
+                    outputs BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    @staticmethod
+    def get_key(checksum, extractor, version):
+        """
+        Build the cache key of an input file.
+        :param checksum: SHA-256 checksum of the input file
+        :param extractor: name of the extractor used for the file
+        :param version: version of the extractor
+        :return: cache key
+        """
+        return F"{checksum}:{extractor}:{version}"
+
+    def get(self, key):
+        """
+        Retrieve the cached outputs of an input file, marking them as recently used.
+        :param key: cache key of the input file
+        :return: tuple of the path of the file the outputs were produced from and a dictionary of output suffixes
+        to output file contents, or None if the file is not cached
+        """
+        with self.__lock, self.__connection:
+            row = self.__connection.execute("SELECT source, outputs FROM results WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.__connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        if not row:
+            return None
+        return row[0], json.loads(zlib.decompress(row[1]).decode("utf-8"))
+
+    def store(self, key, source, outputs):
+        """
+        Store the outputs of an input file, then evict the least recently used entries beyond the size limit.
+        :param key: cache key of the input file
+        :param source: path of the input file
+        :param outputs: dictionary of output suffixes to output file contents
+        :return: None
+        """
+        data = zlib.compress(json.dumps(outputs).encode("utf-8"))
+        with self.__lock, self.__connection:
+            self.__connection.execute("""
+                INSERT INTO results (key, source, outputs, size, last_used) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET source = excluded.source, outputs = excluded.outputs,
+                size = excluded.size, last_used = excluded.last_used""",
+                                      (key, source, data, len(data), time.time()))
+            self.__evict()
+
+    def __evict(self):
+        if self.__connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0] <= self.max_size:
+            return
+        total_size = 0
+        evicted = []
+        for key, size in self.__connection.execute("SELECT key, size FROM results ORDER BY last_used DESC"):
+            total_size += size
+            if total_size > self.max_size:
+                evicted.append((key,))
+        if evicted:
+            self.__connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
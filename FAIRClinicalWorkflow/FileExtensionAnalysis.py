@@ -11,11 +11,16 @@ zip_extensions = [".zip", ".7z", ".rar", ".zlib", ".7-zip", ".pzip", ".xz"]
 tar_extensions = [".tgz", ".tar", ".bgz"]
 gzip_extensions = [".gzip", ".gz"]
 archive_extensions = zip_extensions + tar_extensions + gzip_extensions
-from AC.supplementary_processor import image_extensions, word_extensions, spreadsheet_extensions
+from AC.file_types import extension_types, WORD, PDF, SPREADSHEET, IMAGE, POWERPOINT, ARCHIVE
 
 powerpoint_extensions = [".pptx", ".ppt", ".odp"]
-word_extensions.append(".txt")
-image_extensions.append(".bmp")
+# Report groups of each file type, including formats reported but not processed
+file_type_groups = {WORD: "Word", PDF: "PDF", SPREADSHEET: "Table", IMAGE: "Image", POWERPOINT: "Presentation",
+                    ARCHIVE: "Archive"}
+extension_groups = {x: file_type_groups[y] for x, y in extension_types.items() if y in file_type_groups}
+extension_groups.update({x: "Archive" for x in archive_extensions})
+extension_groups.update({x: "Presentation" for x in powerpoint_extensions})
+extension_groups.update({".txt": "Word", ".bmp": "Image"})
 unique_directories = defaultdict(lambda: defaultdict(lambda: {"total": 0}))
 
 
@@ -209,31 +214,7 @@ def list_grouped_file_types(extensions):
                              "Total": 0}
     output_msg = "----- File Type Grouping -----\n"
     for extension, stats in sorted(extensions.items()):
-        if any([extension.endswith(x) for x in spreadsheet_extensions]):
-            total_processed_files["Table"] += stats["total"]
-            total_processed_files["Total"] += stats["total"]
-            continue
-        if any([extension.endswith(x) for x in archive_extensions]):
-            total_processed_files["Archive"] += stats["total"]
-            total_processed_files["Total"] += stats["total"]
-            continue
-        if any([extension.endswith(x) for x in image_extensions]):
-            total_processed_files["Image"] += stats["total"]
-            total_processed_files["Total"] += stats["total"]
-            continue
-        if any([extension.endswith(x) for x in word_extensions]):
-            total_processed_files["Word"] += stats["total"]
-            total_processed_files["Total"] += stats["total"]
-            continue
-        if any([extension.endswith(x) for x in powerpoint_extensions]):
-            total_processed_files["Presentation"] += stats["total"]
-            total_processed_files["Total"] += stats["total"]
-            continue
-        if extension.endswith(".pdf"):
-            total_processed_files["PDF"] += stats["total"]
-            total_processed_files["Total"] += stats["total"]
-            continue
-        total_processed_files["Other"] += stats["total"]
+        total_processed_files[extension_groups.get(extension.lower(), "Other")] += stats["total"]
         total_processed_files["Total"] += stats["total"]
     for file_type in total_processed_files.keys():
         output_msg += F"{file_type}: {total_processed_files[file_type]} files\n"
@@ -1,9 +1,12 @@
+import copy
 import io
 import os
 import secrets
 import shutil
+import struct
 import sys
 import tarfile
+import tempfile
 import zipfile
 from os.path import join, exists, split
 from pathlib import Path
@@ -13,6 +16,21 @@ zip_extensions = [".zip", ".7z", ".rar", ".zlib", ".7-zip", ".pzip", ".xz"]
 tar_extensions = [".tgz", ".tar"]
 gzip_extensions = [".gzip", ".gz"]
 archive_extensions = zip_extensions + tar_extensions + gzip_extensions
+# Leading bytes identifying video containers, as (offset, signature)
+video_signatures = [(4, b"ftyp"), (0, b"\x1a\x45\xdf\xa3"), (0, b"FLV"), (0, b"\x00\x00\x01\xba"),
+                    (0, b"\x00\x00\x01\xb3"), (0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11")]
+# ftyp brands of image formats sharing the ISO base media container
+image_brands = [b"heic", b"heix", b"mif1", b"msf1", b"avif"]
+zip_signature = b"PK\x03\x04"
+zip_end_signature = b"PK\x05\x06"
+zip_central_signature = b"PK\x01\x02"
+zip_end_size = 22
+zip_local_header_size = 30
+zip_descriptor_signature = b"PK\x07\x08"
+zip_encrypted_flag = 0x01
+zip_descriptor_flag = 0x08
+zip64_extra_id = 0x0001
+copy_buffer_size = 1024 * 1024
 #  videos_removed structure
 #  ("PMC12345_supplementary", "PMC12345", my_file.zip OR my_file.mp4, my_archived_video_file.mp4)
 videos_removed = []
@@ -91,42 +109,148 @@ def copy_zip(archive, target_contents, new_output_folder):
                     videos_removed.append((parent_dir, specific_pmc, os.path.split(archive)[1], item.filename))
 
 
-def search_zip(path, remove_video=False, root=True):
+def strip_zip64_extra(extra):
+    """
+    Remove the zip64 field from a member's extra data, as it is rewritten alongside the local header.
+    :param extra: extra data of the member
+    :return: extra data without the zip64 field
+    """
+    stripped = b""
+    position = 0
+    while position + 4 <= len(extra):
+        field_id, field_length = struct.unpack("<HH", extra[position:position + 4])
+        if field_id != zip64_extra_id:
+            stripped += extra[position:position + 4 + field_length]
+        position += 4 + field_length
+    return stripped
+
+
+def copy_raw_member(raw_in, member, zip_write):
+    """
+    Copy a member's compressed data from one zip file to another without decompressing it.
+    :param raw_in: binary file object of the source zip file
+    :param member: ZipInfo of the member in the source zip file
+    :param zip_write: ZipFile open for writing
+    :return: None
+    """
+    raw_in.seek(member.header_offset)
+    local_header = raw_in.read(zip_local_header_size)
+    if local_header[:4] != zip_signature:
+        raise zipfile.BadZipfile(F"Bad local file header for {member.filename}")
+    name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+    raw_in.seek(member.header_offset + zip_local_header_size + name_length + extra_length)
+
+    new_member = copy.copy(member)
+    new_member.extra = strip_zip64_extra(member.extra)
+    # sizes are known, so a data descriptor is only kept where encryption depends on it
+    use_descriptor = member.flag_bits & zip_encrypted_flag and member.flag_bits & zip_descriptor_flag
+    if not use_descriptor:
+        new_member.flag_bits &= ~zip_descriptor_flag
+    zip64 = member.file_size > zipfile.ZIP64_LIMIT or member.compress_size > zipfile.ZIP64_LIMIT
+    new_member.header_offset = zip_write.fp.tell()
+    zip_write.fp.write(new_member.FileHeader(zip64))
+    remaining = member.compress_size
+    while remaining:
+        chunk = raw_in.read(min(remaining, copy_buffer_size))
+        if not chunk:
+            raise zipfile.BadZipfile(F"Truncated data for {member.filename}")
+        zip_write.fp.write(chunk)
+        remaining -= len(chunk)
+    if use_descriptor:
+        descriptor_format = "<4sLQQ" if zip64 else "<4sLLL"
+        zip_write.fp.write(struct.pack(descriptor_format, zip_descriptor_signature, member.CRC,
+                                       member.compress_size, member.file_size))
+    zip_write.filelist.append(new_member)
+    zip_write.NameToInfo[new_member.filename] = new_member
+    zip_write.start_dir = zip_write.fp.tell()
+
+
+def filter_zip_members(path, kept_members, replaced_members):
+    """
+    Rewrite a zip file in place, keeping only the given members.
+
+    Members are copied as raw compressed data, except for nested archives that were filtered themselves, which are
+    stored from their filtered copy.
+    :param path: path to the zip file
+    :param kept_members: list of ZipInfo of the members to keep
+    :param replaced_members: dictionary of member names to the paths of their filtered copies
+    :return: None
+    """
+    temp_path = join(os.path.dirname(path), 'temp_' + secrets.token_hex(5) + '.zip')
+    try:
+        with open(path, "rb") as raw_in, zipfile.ZipFile(temp_path, 'w') as zip_write:
+            for member in kept_members:
+                if member.filename in replaced_members:
+                    zip_write.write(replaced_members[member.filename], member.filename,
+                                    compress_type=zipfile.ZIP_STORED)
+                else:
+                    copy_raw_member(raw_in, member, zip_write)
+        # Replace the original ZIP file with the new one
+        os.replace(temp_path, path)
+    finally:
+        if exists(temp_path):
+            os.remove(temp_path)
+
+
+def extract_nested_zip(zip_ref, member, temp_dir):
+    """
+    Stream a nested archive out of a zip file into a temporary directory.
+    :param zip_ref: open ZipFile containing the nested archive
+    :param member: ZipInfo of the nested archive
+    :param temp_dir: directory the nested archive is extracted to
+    :return: path to the extracted archive
+    """
+    nested_path = join(temp_dir, secrets.token_hex(5) + os.path.splitext(member.filename)[-1].lower())
+    with zip_ref.open(member) as f_in, open(nested_path, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, copy_buffer_size)
+    return nested_path
+
+
+def search_zip(path, remove_video=False, root=True, archive_path=None, temp_dir=None):
     global videos_removed
+    if temp_dir is None:
+        # nested archives are only ever extracted to a directory scoped to this search
+        with tempfile.TemporaryDirectory() as scoped_dir:
+            return search_zip(path, remove_video, root, archive_path, scoped_dir)
+    # videos are logged against the downloaded archive, not the nested archive holding them
+    archive_path = archive_path if archive_path else path
+    parent_dir = Path(archive_path).parent.parent.parts[-1]
+    specific_pmc = parent_dir[parent_dir.find("PMC"):parent_dir.find("_")]
     useful_file_dirs = []
     identified_videos = []
+    kept_members = []
+    replaced_members = {}
     with zipfile.ZipFile(path, 'r') as zip_ref:
         for member in zip_ref.infolist():
             member_extension = os.path.splitext(member.filename)[-1].lower()
             if member_extension in zip_extensions:
-                # Recursively search inside subdirectories
-                nested_useful_dirs, nested_identified_videos = search_zip(zip_ref.extract(member), True, False)
+                # Recursively search inside nested archives
+                nested_path = extract_nested_zip(zip_ref, member, temp_dir)
+                if not zipfile.is_zipfile(nested_path):
+                    useful_file_dirs.append(member.filename)
+                    kept_members.append(member)
+                    continue
+                nested_useful_dirs, nested_identified_videos = search_zip(nested_path, remove_video, False,
+                                                                          archive_path, temp_dir)
                 if nested_identified_videos:
                     identified_videos.extend(nested_identified_videos)
                 if nested_useful_dirs:
                     useful_file_dirs.extend(nested_useful_dirs)
+                    kept_members.append(member)
+                    if nested_identified_videos:
+                        replaced_members[member.filename] = nested_path
             elif "_MACOSX" not in member.filename:
                 if member_extension not in video_extensions:
                     useful_file_dirs.append(member.filename)
+                    kept_members.append(member)
                 else:
-                    parent_dir = Path(path).parent.parent.parts[-1]
-                    specific_pmc = parent_dir[parent_dir.find("PMC"):parent_dir.find("_")]
-                    identified_videos.append((parent_dir, specific_pmc, os.path.split(path)[1], member.filename))
+                    identified_videos.append((parent_dir, specific_pmc, os.path.split(archive_path)[1],
+                                              member.filename))
+    # archives holding only videos are removed whole by the caller, so are only rewritten if content is kept
+    if remove_video and useful_file_dirs and identified_videos:
+        filter_zip_members(path, kept_members, replaced_members)
     # only run if the function is at the root level i.e not in a recursive loop, about to do the final return
-    if root and remove_video and useful_file_dirs:
-        for video in identified_videos:
-            videos_removed.append(video)
-        temp_name = 'temp_' + secrets.token_hex(5) + '.zip'
-        with zipfile.ZipFile(path, 'r') as zip_read:
-            # Create a temporary ZIP file
-            with zipfile.ZipFile(temp_name, 'w') as zip_write:
-                for item in zip_read.infolist():
-                    if item.filename in useful_file_dirs:
-                        zip_write.writestr(item, zip_read.read(item.filename))
-        # Replace the original ZIP file with the new one
-        os.remove(path)
-        shutil.move(temp_name, path)
-    elif root and remove_video:
+    if root and remove_video:
         for video in identified_videos:
             videos_removed.append(video)
 
@@ -189,6 +313,59 @@ def search_tar(path, remove_video=False, root=True):
     return useful_file_dirs, identified_videos
 
 
+def is_video_signature(data):
+    """
+    Identify a video container from the leading bytes of a file.
+    :param data: first bytes of the file
+    :return: True if the bytes match a known video container, False otherwise
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"AVI ":
+        return True
+    for offset, signature in video_signatures:
+        if data[offset:offset + len(signature)] == signature:
+            return signature != b"ftyp" or data[8:12] not in image_brands
+    return False
+
+
+def read_zip_end_record(tail):
+    """
+    Locate the central directory of a zip file from its trailing bytes.
+    :param tail: last bytes of the zip file, including the end of central directory record
+    :return: tuple of the central directory size and offset, or None if the record was not found
+    """
+    position = tail.rfind(zip_end_signature)
+    if position < 0 or len(tail) - position < zip_end_size:
+        return None
+    entries, directory_size, directory_offset = struct.unpack("<10xHLL", tail[position:position + 20])
+    return directory_size, directory_offset
+
+
+def list_zip_central_directory(directory):
+    """
+    List the member names recorded in a zip central directory.
+    :param directory: bytes of the central directory
+    :return: list of member names
+    """
+    names = []
+    position = 0
+    while directory[position:position + 4] == zip_central_signature:
+        name_length, extra_length, comment_length = struct.unpack("<HHH", directory[position + 28:position + 34])
+        names.append(directory[position + 46:position + 46 + name_length].decode("utf-8", errors="replace"))
+        position += 46 + name_length + extra_length + comment_length
+    return names
+
+
+def contains_only_videos(archived_files):
+    """
+    Check whether the members of an archive are all videos, ignoring folders and macOS metadata.
+    :param archived_files: list of member names
+    :return: True if the archive holds at least one video and nothing else, False otherwise
+    """
+    archived_files = [x for x in archived_files if not x.endswith("/") and "_MACOSX" not in x]
+    return bool(archived_files) and all(
+        [any([x.lower().endswith(y) for y in video_extensions]) for x in archived_files])
+
+
 def format_excluded_pmc(pmc):
     if "PMC" not in pmc:
         pmc = F"PMC{pmc}"
@@ -208,12 +385,32 @@ def generate_video_log(videos, log_path):
                 f_out.write(F"{format_excluded_pmc(pmc)}\t{url}\n")
 
 
+def read_skipped_download_log(log_directory):
+    """
+    Read the supplementary files skipped by the download pre-flight checks. The log is left in place until its
+    entries have been written to the excluded log.
+    :param log_directory: supplementary output directory
+    :return: list of excluded log entries
+    """
+    skipped_log_path = join(log_directory, "download_skipped.tsv")
+    excluded_log_entries = []
+    if not exists(skipped_log_path):
+        return excluded_log_entries
+    with open(skipped_log_path, "r", encoding="utf-8") as f_in:
+        for line in f_in.readlines():
+            folder, pmcid, url, reason = line.rstrip("\n").split("\t")
+            if (pmcid, url, None) not in excluded_log_entries:
+                excluded_log_entries.append((pmcid, url, None))
+    return excluded_log_entries
+
+
 def copy_download_log(input_directory):
     log_directory = input_directory
     pmc = get_pmc_from_path(input_directory)
     download_log_path = join(log_directory, F"download_log.tsv")
     included_log_path = download_log_path.replace("download_log", F"{pmc}_json_ascii_supplementary_included")
-    excluded_log_entries = []
+    # files skipped before download are excluded without reaching the download log
+    excluded_log_entries = read_skipped_download_log(log_directory)
     try:
         with open(download_log_path, "r", encoding="utf-8") as f_in, open(included_log_path, "w+",
                                                                           encoding="utf-8") as included_out:
@@ -246,10 +443,16 @@ def copy_download_log(input_directory):
                 included_out.write(F"{pmcid}_supplementary\t{pmcid}\t{url}\n")
     except IOError as io:
         print(F"Download log file not found. Failed to produce the new excluded supplementary log file.")
+        # the files skipped before download are still recorded
+        if excluded_log_entries:
+            generate_video_log(excluded_log_entries, log_directory)
+            os.remove(join(log_directory, "download_skipped.tsv"))
         return
     generate_video_log(excluded_log_entries, log_directory)
-    # remove the download log
+    # remove the download log, and the skipped download log now its entries are in the excluded log
     os.remove(download_log_path)
+    if exists(join(log_directory, "download_skipped.tsv")):
+        os.remove(join(log_directory, "download_skipped.tsv"))
 
 
 def get_pmc_from_path(path):
@@ -1,122 +1,365 @@
+import argparse
 import json
 import os
 import pathlib
-import sys
+import re
+import tarfile
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
 from bioc import biocjson
 
+# Number of bytes scanned from the start of an article when pre-filtering titles
+title_scan_limit = 64 * 1024
+passages_pattern = re.compile(r'(?<!\\)"passages"\s*:\s*\[\s*')
+# Maximum number of articles sent to a filter worker at once
+filter_chunk_size = 500
+
+
+def get_title_row(article, search_str):
+    """
+    Build the title list row of a full-text article.
+    :param article: BioC collection
+    :param search_str: search string matched against article titles
+    :return: (PMC ID, title) tuple
+    """
+    id = article.documents[0].id
+    title = article.documents[0].passages[0].text
+    subtitle = article.documents[0].passages[0].infons["subtitle"] \
+        if "subtitle" in article.documents[0].passages[0].infons.keys() else ""
+    if "PMC" not in id:
+        id = F"PMC{id}"
+    title = title.replace("\t", " ")
+    if search_str.lower() not in title.lower():
+        subtitle = subtitle.replace("\t", " ")
+        title = F"{title} {subtitle}"
+    return id, title
+
+
+def write_title_list(title_rows, dir):
+    """
+    Write the full-text article title list of a filtered archive directory.
+    :param title_rows: list of (PMC ID, title) tuples
+    :param dir: filtered archive directory
+    :return: None
+    """
+    with open(os.path.join(dir, F"{pathlib.Path(dir).parts[-1]}_articles.tsv"), "w+", encoding="utf-8") as f_out:
+        for id, title in title_rows:
+            f_out.write(F"{id}\t{title}\n")
+
 
 def generate_title_list(dir, search_str):
     article_title_list = []
     for file in [x for x in os.listdir(dir) if x.endswith(".json")]:
         with open(os.path.join(dir, file), "r") as f_in:
             article = biocjson.load(f_in)
-            article_title_list.append((article.documents[0].id, article.documents[0].passages[0].text,
-                                       article.documents[0].passages[0].infons["subtitle"]
-                                       if "subtitle" in article.documents[0].passages[0].infons.keys() else ""))
-    with open(os.path.join(os.path.split(dir)[0], F"{pathlib.Path(dir).parent.parts[-1]}_articles.tsv"), "w+", encoding="utf-8") as f_out:
-        for id, title, subtitle in article_title_list:
-            if "PMC" not in id:
-                id = F"PMC{id}"
-            title = title.replace("\t", " ")
-            if search_str.lower() in title.lower():
-                f_out.write(F"{id}\t{title}\n")
-            else:
-                subtitle = subtitle.replace("\t", " ")
-                f_out.write(F"{id}\t{title} {subtitle}\n")
-
-
-def scan_bioc_files(results):
-    problem_count = 0
-    parsed_count = 0
-    abstract_only = 0
-    title_only = 0
-    file_count = len(results)
-    for file_path in results:
-        bioc = None
+            article_title_list.append(get_title_row(article, search_str))
+    write_title_list(article_title_list, os.path.split(dir)[0])
+
+
+def loads_pmc_bioc(text):
+    """
+    Load a BioC collection from PMC BioC JSON content.
+    :param text: BioC JSON string
+    :return: BioC collection
+    """
+    try:
+        return biocjson.loads(text)
+    except:
+        # PMC puts the BioC collection INSIDE an array,
+        # so we expand it before loading with bioc module
+        bioc = json.loads(text)[0]
+        return biocjson.loads(json.dumps(bioc))
+
+
+def read_title_passage(data, limit=title_scan_limit):
+    """
+    Read the text and subtitle of the first passage from raw BioC JSON content, without parsing the whole article.
+    :param data: BioC JSON content (bytes or str), or at least its first bytes
+    :param limit: number of bytes scanned from the start of the content
+    :return: (text, subtitle) tuple, or None if the first passage could not be read within the limit
+    """
+    head = data[:limit]
+    if isinstance(head, bytes):
+        head = head.decode("utf-8", errors="ignore")
+    match = passages_pattern.search(head)
+    if not match:
+        return None
+    try:
+        passage = json.JSONDecoder().raw_decode(head, match.end())[0]
+    except ValueError:
+        return None
+    if not isinstance(passage, dict):
+        return None
+    infons = passage.get("infons") or {}
+    return str(passage.get("text") or ""), str(infons.get("subtitle") or "")
+
+
+def title_prefilter(data, title):
+    """
+    Fast check of whether an article may match the title, using only the start of its raw BioC JSON content.
+    :param data: BioC JSON content (bytes or str), or at least its first bytes
+    :param title: search string
+    :return: False if the article does not match, True if it matches or the first passage could not be read
+    """
+    first_passage = read_title_passage(data)
+    if first_passage is None:
+        return True
+    text, subtitle = first_passage
+    return title.lower() in text.lower() or title.lower() in subtitle.lower()
+
+
+def title_matches(bioc, title):
+    """
+    Check whether the title or subtitle of an article contains the search string.
+    :param bioc: BioC collection
+    :param title: search string
+    :return: True if the title or subtitle contains the search string, False otherwise
+    """
+    first_passage = bioc.documents[0].passages[0]
+    if title.lower() in first_passage.text.lower():
+        return True
+    return "subtitle" in first_passage.infons.keys() and title.lower() in first_passage.infons["subtitle"].lower()
+
+
+def get_article_folder(bioc):
+    """
+    Identify the output folder of an article from the section type of its final passage.
+    :param bioc: BioC collection
+    :return: "Titles", "Abstracts" or "Full-texts"
+    """
+    section_type = bioc.documents[0].passages[-1].infons["section_type"].lower()
+    if section_type == "title":
+        return "Titles"
+    elif section_type == "abstract":
+        return "Abstracts"
+    return "Full-texts"
+
+
+def filter_article(data, file, output_dir, title):
+    """
+    Parse a candidate article once, classify it and write it to its output folder.
+    :param data: BioC JSON content (bytes or str)
+    :param file: output file name
+    :param output_dir: directory containing the Titles, Abstracts and Full-texts folders
+    :param title: search string matched against article titles and subtitles
+    :return: None if the article does not match, otherwise (output folder, title row) with a title row
+    only for full-text articles
+    """
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    bioc = loads_pmc_bioc(data)
+    if not title_matches(bioc, title):
+        return None
+    folder = get_article_folder(bioc)
+    with open(os.path.join(output_dir, folder, file), "w+") as f_out:
+        biocjson.dump(bioc, f_out)
+    return folder, get_title_row(bioc, title) if folder == "Full-texts" else None
+
+
+def filter_candidates(candidates, output_dir, title):
+    """
+    Classify and write candidate articles, counting the outcomes and collecting full-text title rows.
+    :param candidates: iterable of (file name, BioC JSON content) pairs which passed the title pre-filter
+    :param output_dir: directory containing the Titles, Abstracts and Full-texts folders
+    :param title: search string matched against article titles and subtitles
+    :return: (counts, title rows) tuple
+    """
+    counts = Counter()
+    title_rows = []
+    for file, data in candidates:
         try:
-            bioc = load_pmc_bioc(file_path)
-            # ensure output folders exist
-            parent_folder = pathlib.PurePath(file_path).parent
-            titles_folder = os.path.join(parent_folder, "Titles")
-            abstract_folder = os.path.join(parent_folder, "Abstracts")
-            full_text_folder = os.path.join(parent_folder, "Full-texts")
-            file = pathlib.PurePath(file_path).name
-
-            if not os.path.exists(titles_folder):
-                os.mkdir(titles_folder)
-
-            if not os.path.exists(abstract_folder):
-                os.mkdir(abstract_folder)
-
-            if not os.path.exists(full_text_folder):
-                os.mkdir(full_text_folder)
-
-            # copy files to seperate folders
-
-            if bioc.documents[0].passages[-1].infons["section_type"].lower() == "title":
-                title_only += 1
-                with open(os.path.join(titles_folder, file), "w+") as f_out:
-                    biocjson.dump(bioc, f_out)
-            elif bioc.documents[0].passages[-1].infons["section_type"].lower() == "abstract":
-                abstract_only += 1
-                with open(os.path.join(abstract_folder, file), "w+") as f_out:
-                    biocjson.dump(bioc, f_out)
-            else:
-                with open(os.path.join(full_text_folder, file), "w+") as f_out:
-                    biocjson.dump(bioc, f_out)
-            parsed_count += 1
+            result = filter_article(data, file, output_dir, title)
         except Exception as ex:
-            print(file_path)
-            problem_count += 1
+            print(file)
+            counts["files"] += 1
+            counts["bad"] += 1
+            continue
+        if result is None:
+            continue
+        folder, title_row = result
+        counts["files"] += 1
+        counts["parsed"] += 1
+        counts[folder] += 1
+        if title_row:
+            title_rows.append(title_row)
+    return counts, title_rows
 
-    print(F"Bad files: {problem_count} / {file_count}")
-    print(F"Parsed files: {parsed_count} / {file_count}")
-    print(F"Title only: {title_only} / {file_count}")
-    print(F"Abstract only: {abstract_only} / {file_count}")
-    print(F"Full text: {file_count - (title_only + abstract_only + problem_count)} / {file_count}")
 
+def print_filter_summary(counts):
+    file_count = counts["files"]
+    print(F"Bad files: {counts['bad']} / {file_count}")
+    print(F"Parsed files: {counts['parsed']} / {file_count}")
+    print(F"Title only: {counts['Titles']} / {file_count}")
+    print(F"Abstract only: {counts['Abstracts']} / {file_count}")
+    print(F"Full text: {file_count - (counts['Titles'] + counts['Abstracts'] + counts['bad'])} / {file_count}")
 
-def load_pmc_bioc(file_path):
-    bioc = None
-    with open(file_path, "r") as f_in:
-        try:
-            bioc = biocjson.load(f_in)
-        except:
-            # PMC puts the BioC collection INSIDE an array,
-            # so we expand it before loading with bioc module
-            bioc = json.load(f_in)
-            bioc = bioc[0]
-            bioc = biocjson.loads(json.dumps(bioc))
-            with open(file_path, "w+") as f_out:
-                biocjson.dump(bioc, f_out)
-    return bioc
-
-
-def filter_manually(dir, title):
-    results = []
-    for file in [x for x in os.listdir(dir) if x.endswith(".xml") and not x.startswith("._")]:
+
+def create_output_folders(output_dir):
+    for folder in ["Titles", "Abstracts", "Full-texts"]:
+        if not os.path.exists(os.path.join(output_dir, folder)):
+            os.makedirs(os.path.join(output_dir, folder))
+
+
+def read_archive_candidates(archive_path, title):
+    """
+    Read the articles of a PMC BioC archive which pass the title pre-filter, in archive order.
+    :param archive_path: path to a PMC BioC .tar.gz archive
+    :param title: search string matched against article titles and subtitles
+    :return: generator of (file name, BioC JSON bytes) pairs
+    """
+    with tarfile.open(archive_path, "r|gz") as archive:
+        for member in archive:
+            file = os.path.basename(member.name)
+            if not member.isfile() or not file.endswith(".xml") or file.startswith("._"):
+                continue
+            data = archive.extractfile(member).read()
+            if title_prefilter(data, title):
+                yield file.replace(".xml", ".json"), data
+
+
+def read_directory_candidates(dir, title, files=None):
+    """
+    Rename the extracted articles of a PMC BioC archive to .json and read those which pass the title pre-filter.
+    :param dir: extracted archive directory
+    :param title: search string matched against article titles and subtitles
+    :param files: article file names to read, or None to read every article in the directory
+    :return: generator of (file name, BioC JSON bytes) pairs
+    """
+    if files is None:
+        files = list_directory_articles(dir)
+    for file in files:
         file_path = os.path.join(dir, file)
         os.rename(file_path, file_path.replace(".xml", ".json"))
         file_path = file_path.replace(".xml", ".json")
-        # load file to ensure
-        bioc = load_pmc_bioc(file_path)
-        if title.lower() in bioc.documents[0].passages[0].text.lower():
-            results.append(file_path)
-        elif ("subtitle" in bioc.documents[0].passages[0].infons.keys() and
-              title.lower() in bioc.documents[0].passages[0].infons["subtitle"].lower()):
-            results.append(file_path)
+        with open(file_path, "rb") as f_in:
+            data = f_in.read(title_scan_limit)
+            if not title_prefilter(data, title):
+                continue
+            data += f_in.read()
+        yield os.path.basename(file_path), data
+
+
+def list_directory_articles(dir):
+    return sorted([x for x in os.listdir(dir) if x.endswith(".xml") and not x.startswith("._")])
+
+
+def filter_directory_chunk(dir, files, title):
+    """
+    Filter a chunk of the articles in an extracted archive directory.
+    :param dir: extracted archive directory
+    :param files: article file names
+    :param title: search string matched against article titles and subtitles
+    :return: (counts, title rows) tuple
+    """
+    return filter_candidates(read_directory_candidates(dir, title, files), dir, title)
+
+
+def get_chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def run_filter_tasks(func, tasks, workers=1, pool=None):
+    """
+    Run filter tasks, across a process pool when more than one worker is used, and merge their results.
+
+    Results are merged in task order, so the counts and title list match a single process run.
+    :param func: filter function returning (counts, title rows)
+    :param tasks: iterable of argument tuples for the filter function
+    :param workers: number of worker processes
+    :param pool: existing process pool executor to use instead of creating one
+    :return: (counts, title rows) tuple
+    """
+    counts = Counter()
+    title_rows = []
+
+    def merge(result):
+        task_counts, task_title_rows = result
+        counts.update(task_counts)
+        title_rows.extend(task_title_rows)
+
+    if workers <= 1 and pool is None:
+        for args in tasks:
+            merge(func(*args))
+        return counts, title_rows
+    executor = pool if pool is not None else ProcessPoolExecutor(max_workers=workers)
+    try:
+        # bound the number of tasks held in memory at once
+        pending = deque()
+        for args in tasks:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= max(2, workers * 2):
+                merge(pending.popleft().result())
+        while pending:
+            merge(pending.popleft().result())
+    finally:
+        if pool is None:
+            executor.shutdown()
+    return counts, title_rows
+
+
+def filter_archive(archive_path, output_dir, title, workers=1, pool=None):
+    """
+    Filter a PMC BioC archive without extracting it to disk.
+
+    The archive members are read in order from the compressed stream and parsed in memory. Only the
+    articles matching the title are written, to the Titles, Abstracts or Full-texts folder of the output directory.
+    :param archive_path: path to a PMC BioC .tar.gz archive
+    :param output_dir: directory to write the matching articles to
+    :param title: search string matched against article titles and subtitles
+    :param workers: number of processes used to parse and write candidate articles
+    :param pool: existing process pool executor to use instead of creating one
+    :return: None
+    """
+    create_output_folders(output_dir)
+    candidates = read_archive_candidates(archive_path, title)
+    if workers <= 1 and pool is None:
+        counts, title_rows = filter_candidates(candidates, output_dir, title)
+    else:
+        tasks = ((chunk, output_dir, title) for chunk in get_chunks(candidates, filter_chunk_size))
+        counts, title_rows = run_filter_tasks(filter_candidates, tasks, workers, pool)
+    print_filter_summary(counts)
+    write_title_list(title_rows, output_dir)
+
 
-    scan_bioc_files(results)
+def filter_manually(dir, title, workers=1, pool=None):
+    """
+    Filter an extracted PMC BioC archive directory.
 
-    generate_title_list(os.path.join(dir, "Full-texts"), title)
+    Each article is parsed once; matching articles are written to the Titles, Abstracts or Full-texts folder
+    and the full-text title list is built from the same parse. With more than one worker, the articles
+    are filtered in chunks across a process pool.
+    :param dir: extracted archive directory
+    :param title: search string matched against article titles and subtitles
+    :param workers: number of worker processes
+    :param pool: existing process pool executor to use instead of creating one
+    :return: None
+    """
+    create_output_folders(dir)
+    files = list_directory_articles(dir)
+    chunk_size = max(1, min(filter_chunk_size, -(-len(files) // (max(1, workers) * 4))))
+    tasks = ((dir, chunk, title) for chunk in get_chunks(files, chunk_size))
+    counts, title_rows = run_filter_tasks(filter_directory_chunk, tasks, workers, pool)
+    print_filter_summary(counts)
+    write_title_list(title_rows, dir)
 
 
 def main():
-    filter_manually(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser("PMC Bulk Filter", description="Filters the articles of an extracted PMC BioC "
+                                                                   "archive by title.")
+    parser.add_argument("directory", help="Extracted PMC BioC archive directory")
+    parser.add_argument("title", help="Search string matched against article titles and subtitles")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+    filter_manually(args.directory, args.title, workers=args.workers)
 
 
 if __name__ == "__main__":
     # example usage
-    # python PMC_BulkFilter.py "D:\\PMC000XXXXX_json_ascii" "case report"
+    # python PMC_BulkFilter.py "D:\\PMC000XXXXX_json_ascii" "case report" --workers 8
     main()
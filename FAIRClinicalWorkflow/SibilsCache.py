@@ -0,0 +1,77 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Shared between archives and worker processes, as images are revisited whenever an archive is updated
+default_cache_path = os.path.join("Output", "sibils_ocr_cache.sqlite")
+# Images missing from SIBiLS are checked again after this many seconds, in case they have since been indexed
+default_miss_ttl = 30 * 24 * 60 * 60
+
+
+class SibilsCache:
+    """
+    On-disk cache of SIBiLS supplementary data documents, keyed by SIBiLS id (<PMCID>_<file name>).
+
+    Ids which SIBiLS reported as missing are stored without a document, so they are not requested again until
+    the miss expires.
+    """
+
+    def __init__(self, path=default_cache_path, miss_ttl=default_miss_ttl):
+        self.path = path
+        self.miss_ttl = miss_ttl
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.__lock, self.__connection:
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    id TEXT PRIMARY KEY,
+                    document TEXT,
+                    updated REAL NOT NULL
+                )""")
+
+    def get(self, sibils_id):
+        """
+        Retrieve the cached result of a SIBiLS id.
+        :param sibils_id: SIBiLS id of the supplementary file
+        :return: tuple of whether the id is cached and its BioC document, which is None for a recorded miss
+        """
+        with self.__lock:
+            row = self.__connection.execute("SELECT document, updated FROM documents WHERE id = ?",
+                                            (sibils_id,)).fetchone()
+        if not row:
+            return False, None
+        document, updated = row
+        if document is None:
+            return time.time() - updated < self.miss_ttl, None
+        return True, json.loads(document)
+
+    def get_uncached(self, sibils_ids):
+        """
+        Find which SIBiLS ids have no cached result.
+        :param sibils_ids: list of SIBiLS ids
+        :return: list of the ids which are not cached or whose miss has expired, in their original order
+        """
+        return [x for x in sibils_ids if not self.get(x)[0]]
+
+    def store(self, results):
+        """
+        Store the results of SIBiLS requests.
+        :param results: dictionary of SIBiLS ids to their BioC documents, or None for ids SIBiLS does not hold
+        :return: None
+        """
+        updated = time.time()
+        with self.__lock, self.__connection:
+            self.__connection.executemany("""
+                INSERT INTO documents (id, document, updated) VALUES (?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET document = excluded.document, updated = excluded.updated""",
+                                          [(sibils_id, None if document is None else json.dumps(document), updated)
+                                           for sibils_id, document in results.items()])
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
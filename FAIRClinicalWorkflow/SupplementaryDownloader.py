@@ -1,11 +1,16 @@
 import argparse
+import hashlib
 import os
-import random
 import re
 import sys
+import threading
 import time
-from os.path import isfile, join, exists
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os.path import isfile, join
 from pathlib import Path
+from urllib.parse import urlparse
+
 import requests
 from bioc import biocjson
 from lxml import etree
@@ -14,7 +19,10 @@ import logging
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 
-from FAIRClinicalWorkflow.MovieRemoval import video_extensions
+from FAIRClinicalWorkflow.ArticlePageCache import ArticlePageCache
+from FAIRClinicalWorkflow.DownloadManifest import DownloadManifest, STARTED
+from FAIRClinicalWorkflow.MovieRemoval import video_extensions, archive_extensions, is_video_signature, \
+    zip_signature, zip_end_size, read_zip_end_record, list_zip_central_directory, contains_only_videos
 
 refs_log = logging.getLogger("ReferenceLogger")
 refs_handler = logging.FileHandler("FailedSuppLinks.log")
@@ -25,11 +33,90 @@ missing_html_files = []
 no_supp_links = []
 headers = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:101.0) Gecko/20100101 Firefox/101.0"}
 
-
-def get_article_links(pmc_id, session):
+# Politeness defaults, applied per host
+default_download_workers = 4
+default_requests_per_second = 1.0
+default_burst = 1
+default_connections_per_host = 2
+# Streamed download settings
+download_chunk_size = 1024 * 1024
+download_buffer_size = 4 * 1024 * 1024
+# Pre-flight policies, applied before downloading files whose type cannot be trusted from the link alone
+preflight_enabled = True
+max_download_size = None
+skipped_content_types = ["video/"]
+document_extensions = [".pdf", ".doc", ".docx", ".xls", ".xlsx", ".csv", ".tsv", ".txt", ".rtf", ".odt", ".ods",
+                       ".ppt", ".pptx", ".jpg", ".jpeg", ".png", ".gif", ".tif", ".tiff", ".bmp", ".htm", ".html",
+                       ".xml"]
+preflight_sample_size = 16
+# largest zip end of central directory record, including the maximum comment length
+zip_tail_size = zip_end_size + 65535
+log_lock = threading.Lock()
+
+
+class HostRateLimiter:
+    """
+    Enforces per-host politeness limits on outgoing requests.
+
+    Each host has a token bucket limiting the request rate and a semaphore limiting the number of
+    concurrent connections.
+    """
+
+    def __init__(self, requests_per_second=default_requests_per_second, burst=default_burst,
+                 connections_per_host=default_connections_per_host):
+        self.requests_per_second = requests_per_second
+        self.burst = max(1, burst)
+        self.connections_per_host = max(1, connections_per_host)
+        self.__lock = threading.Lock()
+        self.__buckets = {}
+        self.__connections = {}
+
+    def __get_connection_slot(self, host):
+        with self.__lock:
+            if host not in self.__connections:
+                self.__connections[host] = threading.BoundedSemaphore(self.connections_per_host)
+            return self.__connections[host]
+
+    def __take_token(self, host):
+        """
+        Block until a request token is available for the host, then consume it.
+        """
+        if self.requests_per_second <= 0:
+            return
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                tokens, last_refill = self.__buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last_refill) * self.requests_per_second)
+                if tokens >= 1:
+                    self.__buckets[host] = (tokens - 1, now)
+                    return
+                self.__buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.requests_per_second
+            time.sleep(wait)
+
+    @contextmanager
+    def request(self, url):
+        """
+        Context manager held for the duration of a request to the URL's host.
+        """
+        host = urlparse(url).netloc
+        with self.__get_connection_slot(host):
+            self.__take_token(host)
+            yield
+
+
+rate_limiter = HostRateLimiter()
+
+
+def get_article_links(pmc_id, session, page_cache=None):
     response = None
     try:
-        response = session.get(F"https://www.ncbi.nlm.nih.gov/pmc/articles/{pmc_id}", timeout=10)
+        url = F"https://www.ncbi.nlm.nih.gov/pmc/articles/{pmc_id}"
+        # revalidate previously retrieved pages, so unchanged articles are answered with a bodiless 304
+        request_headers = page_cache.get_conditional_headers(pmc_id) if page_cache else {}
+        with rate_limiter.request(url):
+            response = session.get(url, headers=request_headers, timeout=10)
     except requests.ConnectTimeout as ct:
         logging.error(F"{pmc_id} could not be downloaded due to a connection timeout:\n{ct}")
         missing_html_files.append(F"{pmc_id}")
@@ -51,31 +138,230 @@ def get_formatted_pmcid(bioc_file, is_id=False):
 
 def log_download(log_path, downloaded_file_dir, pmc_id, link):
     log_path = os.path.join(log_path, "download_log.tsv")
-    with open(log_path, "a", encoding="utf-8") as f_out:
+    with log_lock, open(log_path, "a", encoding="utf-8") as f_out:
         f_out.write(F"{Path(downloaded_file_dir).parent.parent}\t{pmc_id}\t{link}\n")
 
+def log_skipped_download(log_path, downloaded_file_dir, pmc_id, link, reason):
+    log_path = os.path.join(log_path, "download_skipped.tsv")
+    with log_lock, open(log_path, "a", encoding="utf-8") as f_out:
+        f_out.write(F"{Path(downloaded_file_dir).parent.parent}\t{pmc_id}\t{link}\t{reason}\n")
+
+
 def log_failed_download(file_dir, pmc_id, link, reason):
     set_name = Path(file_dir).parent.parent.name.replace("_supplementary", "")
     log_path = F"Output/{set_name}_failed_downloads.log"
-    with open(log_path, "a", encoding="utf-8") as f_out:
+    with log_lock, open(log_path, "a", encoding="utf-8") as f_out:
         f_out.write(F"{Path(file_dir).parent.name}\t{pmc_id}\t{link}\t{reason}\n")
 
-def download_supplementary_file(link_address, new_dir, pmc_id, parent_dir, session):
+def get_expected_length(file_response, resume_from=0):
+    """
+    Determine the complete size of a streamed download from its response headers.
+    :param file_response: streamed download response
+    :param resume_from: number of bytes already downloaded, if the response continues a range request
+    :return: expected size in bytes, or None if it cannot be determined
+    """
+    content_length = file_response.headers.get("Content-Length")
+    # requests decodes compressed bodies, so the header does not describe the bytes written
+    if not content_length or not content_length.isdigit() or file_response.headers.get("Content-Encoding"):
+        return None
+    return int(content_length) + (resume_from if file_response.status_code == 206 else 0)
+
+
+def stream_response_to_file(file_response, part_file_path, resume_from=0):
+    """
+    Write a streamed download to a partial file, appending to the existing data if a range request was honoured.
+    :param file_response: streamed download response
+    :param part_file_path: path to the partial download file
+    :param resume_from: number of bytes already present in the partial file
+    :return: tuple of the file size, its SHA-256 checksum and whether the expected length was received
+    """
+    checksum = hashlib.sha256()
+    size = 0
+    mode = "wb"
+    if resume_from and file_response.status_code == 206:
+        mode = "ab"
+        with open(part_file_path, "rb") as f_in:
+            for chunk in iter(lambda: f_in.read(download_chunk_size), b""):
+                checksum.update(chunk)
+                size += len(chunk)
+    expected_length = get_expected_length(file_response, resume_from)
+    with open(part_file_path, mode, buffering=download_buffer_size) as f_out:
+        for chunk in file_response.iter_content(chunk_size=download_chunk_size):
+            if chunk:
+                f_out.write(chunk)
+                checksum.update(chunk)
+                size += len(chunk)
+        complete = expected_length is None or size >= expected_length
+        if complete:
+            f_out.flush()
+            os.fsync(f_out.fileno())
+    return size, checksum.hexdigest(), complete
+
+
+def get_range_start(response):
+    """
+    Determine the offset a range response starts from.
+    :param response: response to a range request
+    :return: offset of the first byte in the response body, or None if it cannot be determined
+    """
+    match = re.match(r"bytes\s+(\d+)-", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+def get_range(link_address, session, byte_range):
+    """
+    Request a byte range of a file, reading no more of the body than the range even if the server ignores it.
+    :param link_address: URL of the file
+    :param session: requests session
+    :param byte_range: value of the Range header, without the unit
+    :return: tuple of the response and the bytes read
+    """
+    range_start, range_end = byte_range.split("-")
+    length = int(range_end) - int(range_start) + 1 if range_start and range_end else int(range_end)
+    with rate_limiter.request(link_address):
+        with session.get(link_address, headers={"Range": F"bytes={byte_range}"}, stream=True,
+                         timeout=20) as response:
+            data = response.raw.read(length, decode_content=True) if response.ok else b""
+    return response, data
+
+
+def get_total_size(response):
+    """
+    Determine the complete size of a file from a range response.
+    :param response: response to a range request
+    :return: size in bytes, or None if it cannot be determined
+    """
+    content_range = response.headers.get("Content-Range", "")
+    if response.status_code == 206 and "/" in content_range and content_range.split("/")[-1].isdigit():
+        return int(content_range.split("/")[-1])
+    return get_expected_length(response)
+
+
+def zip_contains_only_videos(link_address, session, size):
+    """
+    Check whether a remote zip file holds only videos by fetching its central directory.
+    :param link_address: URL of the zip file
+    :param session: requests session
+    :param size: size of the zip file in bytes
+    :return: True if every member is a video, False otherwise
+    """
+    response, tail = get_range(link_address, session, F"-{min(size, zip_tail_size)}")
+    if response.status_code != 206:
+        return False
+    end_record = read_zip_end_record(tail)
+    if not end_record:
+        return False
+    directory_size, directory_offset = end_record
+    tail_offset = size - len(tail)
+    if directory_offset >= tail_offset:
+        directory = tail[directory_offset - tail_offset:directory_offset - tail_offset + directory_size]
+    else:
+        response, directory = get_range(link_address, session,
+                                        F"{directory_offset}-{directory_offset + directory_size - 1}")
+        if response.status_code != 206:
+            return False
+    return contains_only_videos(list_zip_central_directory(directory))
+
+
+def preflight_supplementary_file(link_address, session):
+    """
+    Classify a supplementary file before downloading it, using a request for its first bytes.
+
+    The content type, size and leading bytes are checked against the pre-flight policies. Zip files have their
+    central directory inspected, so archives holding only videos are not downloaded.
+    :param link_address: URL of the file
+    :param session: requests session
+    :return: reason for skipping the file, or None if it should be downloaded
+    """
+    file_extension = os.path.splitext(urlparse(link_address).path)[-1].lower()
+    if not preflight_enabled or (file_extension in document_extensions and not max_download_size):
+        return None
+    try:
+        response, data = get_range(link_address, session, F"0-{preflight_sample_size - 1}")
+        if not response.ok:
+            return None
+        content_type = response.headers.get("Content-Type", "").lower()
+        if any([content_type.startswith(x) for x in skipped_content_types]):
+            return F"Skipped content type: {content_type}"
+        size = get_total_size(response)
+        if max_download_size and size and size > max_download_size:
+            return F"Exceeds maximum download size: {size} bytes"
+        if is_video_signature(data):
+            return "Video file signature"
+        if data.startswith(zip_signature) and size and zip_contains_only_videos(link_address, session, size):
+            return "Archive contains only videos"
+    except Exception as ex:
+        logging.warning(F"Pre-flight check failed for {link_address}, downloading it regardless: {ex}")
+    return None
+
+
+def download_supplementary_file(link_address, new_dir, pmc_id, parent_dir, session, manifest=None):
     file_response = None
+    new_file_path = new_dir + "/" + link_address.split("/")[-1].replace(" ", "_")
+    part_file_path = F"{new_file_path}.part"
+    validator = None
+    if manifest:
+        entry = manifest.get(pmc_id, link_address)
+        # a transfer interrupted on an earlier run is resumed if the server still holds the same version
+        if entry and entry["status"] == STARTED:
+            validator = entry["etag"] or entry["last_modified"]
+        manifest.record_started(pmc_id, link_address, new_file_path)
+    try:
+        os.makedirs(new_dir, exist_ok=True)
+    except IOError:
+        logging.error(F"Unable to process {pmc_id}: Unable to create local directory.")
+    # a partial file without a recorded validator cannot be checked against the current resource
+    if os.path.exists(part_file_path) and not validator:
+        os.remove(part_file_path)
     for attempt in range(5):
+        # resume a truncated transfer from the end of the partial file
+        resume_from = os.path.getsize(part_file_path) if os.path.exists(part_file_path) else 0
+        range_headers = {}
+        if resume_from:
+            range_headers["Range"] = F"bytes={resume_from}-"
+            if validator:
+                range_headers["If-Range"] = validator
         try:
-            file_response = session.get(link_address, timeout=20)
-            break
-        except requests.ConnectTimeout as ct:
-            if attempt == 5:
+            with rate_limiter.request(link_address):
+                with session.get(link_address, headers=range_headers, stream=True, timeout=20) as file_response:
+                    if file_response.status_code == 416:
+                        os.remove(part_file_path)
+                        continue
+                    if not file_response.ok:
+                        break
+                    if file_response.status_code == 206 and get_range_start(file_response) != resume_from:
+                        # the body would not continue the partial file, so the transfer starts again
+                        if os.path.exists(part_file_path):
+                            os.remove(part_file_path)
+                        continue
+                    validator = file_response.headers.get("ETag") or file_response.headers.get("Last-Modified")
+                    if manifest:
+                        manifest.record_validator(pmc_id, link_address, file_response.headers.get("ETag"),
+                                                  file_response.headers.get("Last-Modified"))
+                    size, checksum, complete = stream_response_to_file(file_response, part_file_path, resume_from)
+            if not complete:
+                logging.warning(F"Truncated download of {link_address}, {size} bytes received")
+                if attempt == 4:
+                    print(F"{link_address} could not be downloaded as the transfer was truncated")
+                    log_failed_download(new_dir, pmc_id, link_address, F"Truncated download: {size} bytes received")
+                continue
+            os.replace(part_file_path, new_file_path)
+            if manifest:
+                manifest.record_complete(pmc_id, link_address, new_file_path, size, checksum,
+                                         file_response.headers.get("ETag"), file_response.headers.get("Last-Modified"))
+            log_directory = F"{os.path.split(parent_dir)[0]}_supplementary"
+            log_download(log_directory, new_dir, pmc_id, link_address)
+            return True
+        except requests.Timeout as ct:
+            if attempt == 4:
                 print(F"{link_address} could not be downloaded due to a connection timeout")
                 log_failed_download(new_dir, pmc_id, link_address, F"Connection timed out: {ct}")
         except requests.ConnectionError as ce:
-            if attempt == 5:
+            if attempt == 4:
                 print(F"{link_address} could not be downloaded due to a connection error:\n{ce}")
-                log_failed_download(new_dir, pmc_id, link_address,F"Connection error: {ce}")
+                log_failed_download(new_dir, pmc_id, link_address, F"Connection error: {ce}")
         except requests.exceptions.ChunkedEncodingError as ce:
-            if attempt == 5:
+            if attempt == 4:
                 print(F"{link_address} could not be downloaded due to a ChunkedEncodingError error:\n{ce}")
                 log_failed_download(new_dir, pmc_id, link_address, F"ChunkedEncodingError: {ce}")
         except requests.exceptions.InvalidURL as iu:
@@ -84,61 +370,81 @@ def download_supplementary_file(link_address, new_dir, pmc_id, parent_dir, sessi
             log_failed_download(new_dir, pmc_id, link_address, F"Invalid URL: {iu}")
             refs_log.error(F"{pmc_id} - Invalid URL: {link_address}")
             return False
-    try:
-        if file_response and file_response.ok:
-            try:
-                if not exists(new_dir):
-                    os.mkdir(new_dir)
-            except IOError:
-                logging.error(F"Unable to process {pmc_id}: Unable to create local directory.")
-            new_file_path = new_dir + "/" + link_address.split("/")[-1].replace(" ", "_")
-            with open(new_file_path, "wb") as f_out:
-                for chunk in file_response.iter_content(chunk_size=1024 * 8):
-                    if chunk:
-                        f_out.write(chunk)
-                        f_out.flush()
-                        os.fsync(f_out.fileno())
-            log_directory = F"{os.path.split(parent_dir)[0]}_supplementary"
-            log_download(log_directory, new_dir, pmc_id, link_address)
-            return True
-    except IOError as ioe:
-        logging.error(F"Error writing data from {link_address} due to:\n{ioe}")
-        log_failed_download(new_dir, pmc_id, link_address, F"Error writing data locally: {ioe}")
-        print(F"Error writing data from {link_address} due to: {ioe}\n")
-        refs_log.error(F"{pmc_id} - Error writing data from {link_address}")
-    except requests.ConnectionError as ce:
-        logging.error(F"Error connecting to {link_address} due to: \n{ce}")
-        log_failed_download(new_dir, pmc_id, link_address, F"Connection error: {ce}")
-        print(F"Error connecting to {link_address}\n")
-        refs_log.error(F"{pmc_id} - Error connecting to {link_address}")
-    except Exception as ex:
-        logging.error(
-            F"Unexpected error occurred for article {pmc_id}, downloading: {link_address}\n{ex}")
-        print(F"{pmc_id} error downloading {link_address}\n")
-        log_failed_download(new_dir, pmc_id, link_address, F"An unhandled error occurred: {ex}")
-        refs_log.error(F"{pmc_id} - error downloading {link_address}")
+        except requests.RequestException as rex:
+            logging.error(F"Error downloading {link_address} due to:\n{rex}")
+            log_failed_download(new_dir, pmc_id, link_address, F"Request failed: {rex}")
+            print(F"Error downloading {link_address} due to: {rex}\n")
+            refs_log.error(F"{pmc_id} - Request failed for {link_address}")
+            break
+        except IOError as ioe:
+            logging.error(F"Error writing data from {link_address} due to:\n{ioe}")
+            log_failed_download(new_dir, pmc_id, link_address, F"Error writing data locally: {ioe}")
+            print(F"Error writing data from {link_address} due to: {ioe}\n")
+            refs_log.error(F"{pmc_id} - Error writing data from {link_address}")
+            break
+        except Exception as ex:
+            logging.error(
+                F"Unexpected error occurred for article {pmc_id}, downloading: {link_address}\n{ex}")
+            print(F"{pmc_id} error downloading {link_address}\n")
+            log_failed_download(new_dir, pmc_id, link_address, F"An unhandled error occurred: {ex}")
+            refs_log.error(F"{pmc_id} - error downloading {link_address}")
+            break
+    if os.path.exists(part_file_path):
+        os.remove(part_file_path)
     return False
 
 
-def download_supplementary_files(supp_links, new_dir, pmc_id, parent_dir, session):
-    for link in supp_links:
-        link_address = link.attrib['href']
+def download_supplementary_files(supp_links, new_dir, pmc_id, parent_dir, session, manifest=None):
+    for link_address in supp_links:
         if "www." not in link_address and "http" not in link_address:
-            link_address = F"https://pmc.ncbi.nlm.nih.gov{link.attrib['href']}"
+            link_address = F"https://pmc.ncbi.nlm.nih.gov{link_address}"
+        # skip downloads completed on a previous run, and failures not yet due for a retry
+        if manifest and not manifest.should_download(pmc_id, link_address):
+            continue
         if any([link_address.endswith(x) for x in video_extensions]):
             log_directory = F"{os.path.split(parent_dir)[0]}_supplementary"
             log_download(log_directory, new_dir, pmc_id, link_address)
+            if manifest:
+                manifest.record_skipped(pmc_id, link_address)
             continue
-        time.sleep(random.random() * 10)
-        file_response = download_supplementary_file(link_address, new_dir, pmc_id, parent_dir, session)
-
-
-def get_supp_docs(input_directory, bioc_file, session, is_id=False):
+        skip_reason = preflight_supplementary_file(link_address, session)
+        if skip_reason:
+            logging.info(F"{pmc_id}: skipping {link_address}. {skip_reason}")
+            log_directory = F"{os.path.split(parent_dir)[0]}_supplementary"
+            log_skipped_download(log_directory, new_dir, pmc_id, link_address, skip_reason)
+            if manifest:
+                manifest.record_skipped(pmc_id, link_address)
+            continue
+        downloaded = download_supplementary_file(link_address, new_dir, pmc_id, parent_dir, session, manifest)
+        if not downloaded and manifest:
+            manifest.record_failure(pmc_id, link_address)
+
+
+def get_page_supp_links(pmc_id, response, page_cache=None):
+    """
+    Retrieve the supplementary link addresses of an article page response.
+    :param pmc_id: PMC ID of the article
+    :param response: article page response
+    :param page_cache: article page cache used to revalidate the page
+    :return: list of link addresses, or None if the page was not modified and is missing from the cache
+    """
+    if response.status_code == 304:
+        cached_page = page_cache.get(pmc_id) if page_cache else None
+        return cached_page["links"] if cached_page else None
+    supp_links = [x.attrib['href'] for x in etree.HTML(response.text).xpath(
+        "//*[@class='supplementary-materials']//a") if "href" in x.attrib]
+    if page_cache:
+        page_cache.store(pmc_id, response.url, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                         supp_links)
+    return supp_links
+
+
+def get_supp_docs(input_directory, bioc_file, session, is_id=False, manifest=None, page_cache=None):
     pmc_id = get_formatted_pmcid(bioc_file, is_id)
-    response = get_article_links(pmc_id, session)
+    response = get_article_links(pmc_id, session, page_cache)
     if response:
-        if response.ok:
-            supp_links = etree.HTML(response.text).xpath("//*[@class='supplementary-materials']//a")
+        supp_links = get_page_supp_links(pmc_id, response, page_cache) if response.ok else None
+        if supp_links is not None:
             if not supp_links:
                 logging.info(F"{pmc_id} does not contain supplementary links.")
                 no_supp_links.append(F"{pmc_id}")
@@ -146,23 +452,25 @@ def get_supp_docs(input_directory, bioc_file, session, is_id=False):
                 # Create output directory structure
                 file_dir = os.path.split(input_directory)[0] + "_supplementary"
                 file_dir = os.path.join(file_dir, pmc_id + "_supplementary")
-                if not exists(file_dir):
-                    os.makedirs(file_dir)
-                if not exists(os.path.join(file_dir, "Raw")):
-                    os.makedirs(os.path.join(file_dir, "Raw"))
-                if not exists(os.path.join(file_dir, "Processed")):
-                    os.makedirs(os.path.join(file_dir, "Processed"))
+                os.makedirs(os.path.join(file_dir, "Raw"), exist_ok=True)
+                os.makedirs(os.path.join(file_dir, "Processed"), exist_ok=True)
                 new_dir = os.path.join(file_dir, "Raw")
-                download_supplementary_files(supp_links, new_dir, pmc_id, input_directory, session)
+                download_supplementary_files(supp_links, new_dir, pmc_id, input_directory, session, manifest)
         else:
             if response.status_code == 403:
                 logging.error(F"Unauthorized: {pmc_id}")
             missing_html_files.append(F"{pmc_id}")
+            if manifest:
+                manifest.record_article(pmc_id, False)
             return False
     else:
         logging.error(F"Server closed the connection: {pmc_id}")
         missing_html_files.append(F"{pmc_id}")
+        if manifest:
+            manifest.record_article(pmc_id, False)
         return False
+    if manifest:
+        manifest.record_article(pmc_id)
     return True
 
 
@@ -185,12 +493,12 @@ def log_supplementary_article(pmcid):
         f_out.write(F"{pmcid}\n")
 
 
-def get_bioc_supp_docs(input_directory, bioc_file, session, is_id=False):
+def get_bioc_supp_docs(input_directory, bioc_file, session, is_id=False, manifest=None, page_cache=None):
     pmc_id = get_formatted_pmcid(bioc_file, is_id)
     supp_links, has_supp_section = get_bioc_supp_links(bioc_file)
     if has_supp_section:
         logging.info(F"{pmc_id} has supplementary links")
-        get_supp_docs(input_directory, bioc_file, session, is_id)
+        get_supp_docs(input_directory, bioc_file, session, is_id, manifest, page_cache)
     return True
 
 
@@ -203,23 +511,80 @@ def output_problematic_logs():
             f_in.write("\n".join(missing_html_files))
 
 
-def process_directory(input_directory):
+def create_session(workers=1):
     session = requests.Session()
     session.headers.update({"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:101.0) Gecko/20100101 "
                                           "Firefox/101.0"})
     retry = Retry(total=5, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max(10, workers))
     session.mount('https://', adapter)
-    new_files = [x for x in os.listdir(input_directory) if isfile(join(input_directory, x))]
-    skip = True
-    for file in new_files:
-        if ".json" not in file:
-            continue
-        logging.info(F"Processing file {file}")
-        bioc_file = load_file(join(input_directory, file))
-        result = get_bioc_supp_docs(input_directory, bioc_file, session)
-        if not result:
-            missing_html_files.append(F"{bioc_file.documents[0].id}")
+    return session
+
+
+def configure_politeness(requests_per_second=default_requests_per_second, burst=default_burst,
+                         connections_per_host=default_connections_per_host):
+    """
+    Replace the per-host rate limits applied to all requests.
+    :param requests_per_second: sustained request rate allowed per host
+    :param burst: number of requests allowed per host in a burst
+    :param connections_per_host: maximum number of concurrent connections per host
+    :return: None
+    """
+    global rate_limiter
+    rate_limiter = HostRateLimiter(requests_per_second, burst, connections_per_host)
+
+
+def configure_preflight(enabled=True, max_size=None, content_types=None):
+    """
+    Replace the policies applied by the download pre-flight checks.
+    :param enabled: False to download every file without a pre-flight check
+    :param max_size: maximum size of a downloaded file in bytes, or None for no limit
+    :param content_types: content type prefixes that are never downloaded
+    :return: None
+    """
+    global preflight_enabled, max_download_size, skipped_content_types
+    preflight_enabled = enabled
+    max_download_size = max_size
+    if content_types is not None:
+        skipped_content_types = content_types
+
+
+def process_article_file(input_directory, file, session, manifest=None, page_cache=None):
+    logging.info(F"Processing file {file}")
+    bioc_file = load_file(join(input_directory, file))
+    if manifest and manifest.article_complete(get_formatted_pmcid(bioc_file)):
+        logging.info(F"Skipping {file}, its supplementary files were downloaded on a previous run")
+        return
+    result = get_bioc_supp_docs(input_directory, bioc_file, session, manifest=manifest, page_cache=page_cache)
+    if not result:
+        missing_html_files.append(F"{bioc_file.documents[0].id}")
+
+
+def process_directory(input_directory, workers=default_download_workers):
+    """
+    Download the supplementary files of every BioC article in a directory.
+
+    Articles are processed concurrently by a pool of threads, with requests to each host limited
+    by the module rate limiter. Progress is recorded in a download manifest alongside the supplementary
+    output directory, so re-running an interrupted directory only fetches what is outstanding. Article pages
+    are revalidated against a page cache shared between archives, so unchanged articles are not downloaded again.
+    :param input_directory: directory of BioC JSON articles
+    :param workers: number of articles processed concurrently
+    :return: None
+    """
+    session = create_session(workers)
+    manifest = DownloadManifest(F"{os.path.split(input_directory)[0]}_download_manifest.sqlite")
+    page_cache = ArticlePageCache()
+    new_files = [x for x in os.listdir(input_directory) if isfile(join(input_directory, x)) and ".json" in x]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(process_article_file, input_directory, file, session, manifest, page_cache)
+                       for file in new_files]
+            for future in futures:
+                future.result()
+    finally:
+        manifest.close()
+        page_cache.close()
     output_problematic_logs()
 
 
@@ -270,7 +635,21 @@ def main():
     parser.add_argument("-b", "--bioc_files", required=False)
     parser.add_argument("-p", "--pmc_ids", required=False)
     parser.add_argument("-o", "--output", required=False)
+    parser.add_argument("-t", "--threads", type=int, default=default_download_workers,
+                        help="Number of articles processed concurrently")
+    parser.add_argument("-r", "--rate", type=float, default=default_requests_per_second,
+                        help="Maximum requests per second to each host")
+    parser.add_argument("--burst", type=int, default=default_burst,
+                        help="Number of requests allowed to each host in a burst")
+    parser.add_argument("-c", "--connections-per-host", type=int, default=default_connections_per_host,
+                        help="Maximum concurrent connections to each host")
+    parser.add_argument("--max-size", type=float, default=None,
+                        help="Maximum size of a downloaded file in megabytes")
+    parser.add_argument("--no-preflight", action="store_true",
+                        help="Download every file without checking its type and size first")
     args = parser.parse_args()
+    configure_politeness(args.rate, args.burst, args.connections_per_host)
+    configure_preflight(not args.no_preflight, int(args.max_size * 1024 * 1024) if args.max_size else None)
     input_directory = args.bioc_files
     output_directory = args.output
     input_pmcs = args.pmc_ids
@@ -279,7 +658,7 @@ def main():
     if not input_directory:
         process_pmc_list(input_pmcs, output_directory)
     else:
-        process_directory(input_directory)
+        process_directory(input_directory, args.threads)
 
 
 if __name__ == "__main__":
@@ -1,24 +1,38 @@
+import argparse
 import logging
 import os
+import queue
 import shutil
 import tarfile
+import threading
 
 import ftplib
 import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from datetime import datetime
 from pathlib import Path
 
 import regex
 
-from FAIRClinicalWorkflow.MovieRemoval import execute_movie_removal, video_extensions
-from FAIRClinicalWorkflow.PMC_BulkFilter import filter_manually as filter_articles
+from FAIRClinicalWorkflow.MovieRemoval import execute_movie_removal
+from FAIRClinicalWorkflow.PMC_BulkFilter import filter_manually as filter_articles, filter_archive
 from FAIRClinicalWorkflow.SupplementaryDownloader import process_directory as get_supplementary_files
-from AC.supplementary_processor import process_supplementary_files
+from AC.supplementary_processor import process_supplementary_files, initialise_pdf_worker, process_image_batch
+from FAIRClinicalWorkflow.image_extractor import prefetch_sibils_ocr, configure_ocr, ocr_backends
+from AC.file_types import detect_file_type, get_extension_type, VIDEO, PDF, IMAGE, ARCHIVE
 
 # FTP connection
 ftp_server = "ftp.ncbi.nlm.nih.gov"
 ftp_directory = "/pub/wilbur/BioC-PMC/"
 
+# Pipeline settings
+default_workers = max(1, (os.cpu_count() or 1) - 1)
+default_pipeline_depth = 2
+# Physical memory reserved for each PDF worker, which holds its own copy of the marker models
+default_pdf_worker_memory_gb = 6
+default_pdf_batch_multiplier = 1
+
 logging.basicConfig(filename="Workflow_log.txt", filemode="a",
                     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
                     datefmt="%d-%m-%y %H:%M:%S", level=logging.INFO)
@@ -112,26 +126,50 @@ def extract_archive(archive_path, output_path):
     os.remove(archive_path)
 
 
-def process_new_archive(new_archive_path):
+def extract_and_filter_archive(archive_path, output_path, pool=None, stream=False, workers=1):
+    """
+    Extract an archive and filter its case report articles.
+
+    In streaming mode the archive is never extracted; its members are filtered in memory and only the
+    matching articles are written to the output directory.
+    :param archive_path: path to an archive file
+    :param output_path: path to an output directory
+    :param pool: process pool executor used for CPU-bound stages
+    :param stream: True to filter the archive members without extracting the archive
+    :param workers: number of processes in the process pool
+    :return: None
+    """
+    if stream:
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        filter_archive(archive_path, output_path, "case report", workers, pool)
+        os.remove(archive_path)
+    else:
+        extract_archive(archive_path, output_path)
+        filter_articles(output_path, "case report", workers, pool)
+
+
+def process_new_archive(new_archive_path, pool=None, stream=False, workers=1, pdf_pool=None):
     """
     Process a brand-new archive, downloading supplementary files and standardising them.
 
     :param: new_archive_path: path to brand-new archive
+    :param pool: process pool executor used for CPU-bound stages
+    :param stream: True to filter the archive members without extracting the archive
+    :param workers: number of processes in the process pool
+    :param pdf_pool: process pool executor with the marker models loaded, used for PDF files
     :return: None
     """
-    # Extract archive to the same location
+    # Extract archive to the same location and process full text articles
     output_path = new_archive_path.rstrip(".tar.gz")
-    extract_archive(new_archive_path, output_path)
-
-    # process full text articles
+    extract_and_filter_archive(new_archive_path, output_path, pool, stream, workers)
     full_text_folder = os.path.join(output_path, "Full-texts")
-    filter_articles(output_path, "case report")
 
     # process supplementary files
     supplementary_output_path = F"{output_path}_supplementary"
     get_supplementary_files(full_text_folder)
     execute_movie_removal(supplementary_output_path)
-    standardise_supplementary_files(supplementary_output_path)
+    standardise_supplementary_files(supplementary_output_path, pool, pdf_pool)
     # Clean unnecessary unprocessed log records
     clean_unprocessed_log(supplementary_output_path)
     archive_final_output(new_archive_path)
@@ -167,10 +205,99 @@ def onerror(func, path, exc_info):
         raise
 
 
-def standardise_supplementary_files(supplementary_output_path: str):
+def remove_temp_extracted_files():
+    """
+    Remove the temporary folder used while standardising archived supplementary files.
+    :return: None
+    """
+    try:
+        if os.path.exists("temp_extracted_files"):
+            shutil.rmtree("temp_extracted_files", ignore_errors=False, onerror=onerror)
+    except PermissionError as pe:
+        print(F"Unable to remove the temp folder's contents due to a permission error: {pe}")
+
+
+def get_supplementary_pmcid(file):
+    """
+    Retrieve the PMC ID from the path of a supplementary file.
+    :param file: path to the supplementary file
+    :return: PMC ID of the article the file belongs to
+    """
+    return regex.search(r"(PMC[0-9]*_supplementary)", file)[0].replace("_supplementary", "")
+
+
+def standardise_supplementary_file(file):
+    """
+    Standardise a single supplementary file.
+    :param file: path to the supplementary file
+    :return: list of (file, archived file, reason) tuples for files which could not be processed
+    """
+    unprocessed = []
+    try:
+        pmcid = get_supplementary_pmcid(file)
+        success, failed_files, reason = process_supplementary_files([file], pmcid=pmcid)
+        if not reason:
+            reason = "Failed to identify extractable text"
+        if not success:
+            if failed_files:
+                for failed_file in failed_files:
+                    unprocessed.append((file, failed_file.filename, reason))
+            else:
+                unprocessed.append((file, "", reason))
+    except Exception as ex:
+        unprocessed.append((file, "", F"An error occurred: {ex}"))
+    return unprocessed
+
+
+def standardise_image_batch(batch):
+    """
+    Standardise the supplementary images of one article, retrieving their OCR results concurrently.
+    :param batch: tuple of the PMC ID and the list of image file paths
+    :return: list of (file, archived file, reason) tuples for files which could not be processed
+    """
+    pmcid, files = batch
+    unprocessed = []
+    try:
+        for file, (success, reason) in zip(files, process_image_batch(files, pmcid)):
+            if not success:
+                unprocessed.append((file, "", reason if reason else "Failed to identify extractable text"))
+    except Exception as ex:
+        unprocessed.extend([(file, "", F"An error occurred: {ex}") for file in files])
+    return unprocessed
+
+
+def get_image_batches(files):
+    """
+    Group supplementary image files by the article they belong to.
+    :param files: list of image file paths
+    :return: list of (PMC ID, list of file paths) tuples
+    """
+    batches = {}
+    for file in files:
+        batches.setdefault(get_supplementary_pmcid(file), []).append(file)
+    return list(batches.items())
+
+
+def get_pdf_worker_limit(workers, memory_per_worker_gb=default_pdf_worker_memory_gb):
+    """
+    Determine how many PDF workers fit in physical memory.
+    :param workers: maximum number of workers
+    :param memory_per_worker_gb: physical memory needed by each worker, in gigabytes
+    :return: number of PDF workers to run
+    """
+    try:
+        physical_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return max(1, workers)
+    return max(1, min(workers, int(physical_memory // (memory_per_worker_gb * 1024 ** 3))))
+
+
+def standardise_supplementary_files(supplementary_output_path: str, pool=None, pdf_pool=None):
     """
     Standardise all supported supplementary files within the given directory
     :param supplementary_output_path: path to supplementary files
+    :param pool: process pool executor used to standardise files concurrently
+    :param pdf_pool: process pool executor with the marker models loaded, used for PDF files and archives
     :return: None
     """
     dirs = [(dirpath, dirname, filename) for (dirpath, dirname, filename) in
@@ -179,42 +306,52 @@ def standardise_supplementary_files(supplementary_output_path: str):
     for dir_list in dirs:
         for file in dir_list[2]:
             filepaths.append(os.path.join(dir_list[0], file))
-    for file in filepaths:
-        if file.endswith("_bioc.json") or file.endswith("_tables.json") or any(
-                [file.lower().endswith(x) for x in video_extensions]):
-            continue
-        try:
-            pmcid = regex.search(r"(PMC[0-9]*_supplementary)", file)[0].replace("_supplementary", "")
-            success, failed_files, reason = process_supplementary_files([file], pmcid=pmcid)
-            if not reason:
-                reason = "Failed to identify extractable text"
-            if not success:
-                if failed_files:
-                    for failed_file in failed_files:
-                        log_unprocessed_supplementary_file(file, failed_file.filename,
-                                                           reason,
-                                                           supplementary_output_path)
-                else:
-                    log_unprocessed_supplementary_file(file, "", reason,
-                                                       supplementary_output_path)
-        except Exception as ex:
-            log_unprocessed_supplementary_file(file, "", F"An error occurred: {ex}", supplementary_output_path)
-            try:
-                if os.path.exists("temp_extracted_files"):
-                    shutil.rmtree("temp_extracted_files", ignore_errors=False, onerror=onerror)
-            except PermissionError as pe:
-                print(F"Unable to remove the temp folder's contents due to a permission error: {pe}")
-
-
-def update_existing_archive(new_archive_path):
+    # videos are skipped by extension or, when mislabelled, by their contents
+    filepaths = [x for x in filepaths if not (x.endswith("_bioc.json") or x.endswith("_tables.json") or VIDEO in (
+        get_extension_type(x), detect_file_type(x)))]
+    file_types = {x: detect_file_type(x) for x in filepaths}
+    # images of each article are sent to the OCR services together, so their requests overlap
+    image_batches = get_image_batches([x for x in filepaths if file_types[x] == IMAGE])
+    # OCR results SIBiLS already holds are fetched for the whole directory in a few multi-id requests
+    try:
+        prefetch_sibils_ocr([(file, pmcid) for pmcid, files in image_batches for file in files])
+    except Exception as ex:
+        logger.warning(F"Unable to prefetch SIBiLS OCR results: {ex}")
+    if pool is None:
+        other_files = [x for x in filepaths if file_types[x] != IMAGE]
+        results = chain(map(standardise_supplementary_file, other_files), map(standardise_image_batch, image_batches))
+    else:
+        # PDFs go to the workers holding the marker models, so the other workers never load them. The largest are
+        # submitted first, so they do not hold up the end of the directory. File size stands in for the page count,
+        # which is only read in the worker, from the same pdfplumber handle used for extraction.
+        # Archives may hold PDFs, so they also go to those workers, keeping marker within the PDF worker memory cap.
+        pdf_files = [x for x in filepaths if file_types[x] in (PDF, ARCHIVE)] if pdf_pool else []
+        pdf_files.sort(key=os.path.getsize, reverse=True)
+        batched_files = set(pdf_files).union([x for x in filepaths if file_types[x] == IMAGE])
+        other_files = [x for x in filepaths if x not in batched_files]
+        futures = [pool.submit(standardise_supplementary_file, file) for file in other_files]
+        futures.extend([pool.submit(standardise_image_batch, batch) for batch in image_batches])
+        futures.extend([pdf_pool.submit(standardise_supplementary_file, file) for file in pdf_files])
+        results = (future.result() for future in futures)
+    for unprocessed in results:
+        for file, archived_file, reason in unprocessed:
+            log_unprocessed_supplementary_file(file, archived_file, reason, supplementary_output_path)
+            if pool is None and reason.startswith("An error occurred"):
+                remove_temp_extracted_files()
+    remove_temp_extracted_files()
+
+
+def update_existing_archive(new_archive_path, pool=None, stream=False, workers=1):
     """
     Update an existing archive with an updated version
     :param new_archive_path: path to an archive file
+    :param pool: process pool executor used for CPU-bound stages
+    :param stream: True to filter the archive members without extracting the archive
+    :param workers: number of processes in the process pool
     :return: None
     """
     output_path = new_archive_path.rstrip(".tar.gz")
-    extract_archive(new_archive_path, output_path)
-    filter_articles(output_path, "case report")
+    extract_and_filter_archive(new_archive_path, output_path, pool, stream, workers)
     archive_final_output(new_archive_path)
 
 
@@ -241,60 +378,154 @@ def update_local_archive_versions(archive_name, date_modified, new_archive=False
         f_out.writelines(output)
 
 
-def check_pmc_bioc_updates():
+def get_pending_archives(files, current_versions):
+    """
+    Identify the FTP archives which are brand-new or have been updated since they were last processed.
+    :param files: list of FTP archive file names and dates modified
+    :param current_versions: list of locally processed archive file names and dates modified
+    :return: list of (filename, date modified, new archive) tuples
+    """
+    local_dates = {x[0]: x[1] for x in current_versions if len(x) == 2}
+    pending = []
+    for filename, date_modified in files:
+        # Filter out any files that are not json_ascii.tar.gz
+        if "_json_ascii.tar.gz" not in filename:
+            continue
+        date_modified = date_modified.strftime("%Y-%m-%d %H:%M:%S")
+        # Check for updates to current files or brand-new ones
+        if filename not in local_dates:
+            pending.append((filename, date_modified, True))
+        elif local_dates[filename] < date_modified:
+            pending.append((filename, date_modified, False))
+    return pending
+
+
+def download_archives(pending_archives, downloaded, slots):
+    """
+    Download pending archives in order, handing each one to the processing stage once it is on disk.
+
+    A slot must be acquired before each download, so no more than the pipeline depth of archives
+    are held on disk at any time.
+    :param pending_archives: list of (filename, date modified, new archive) tuples
+    :param downloaded: queue receiving downloaded archives, followed by None once all downloads are complete
+    :param slots: semaphore limiting the number of archives held on disk
+    :return: None
+    """
+    try:
+        for filename, date_modified, new_archive in pending_archives:
+            slots.acquire()
+            if new_archive:
+                logger.info(F"Downloading new archive: {filename}")
+            else:
+                logger.info(F"Updating {filename}")
+            try:
+                with ftplib.FTP(ftp_server) as ftp:
+                    ftp.login()
+                    ftp.cwd(ftp_directory)
+                    download_archive(ftp, filename, "Output")
+            except Exception as ex:
+                logger.error(F"Failed to download {filename}: {ex}")
+                slots.release()
+                continue
+            downloaded.put((filename, date_modified, new_archive))
+    finally:
+        downloaded.put(None)
+
+
+def initialise_worker(ocr_backend, ocr_workers):
+    """
+    Process pool initializer applying the OCR configuration of the parent, which spawned workers do not inherit.
+    :param ocr_backend: OCR backend used for supplementary images
+    :param ocr_workers: number of tesseract processes run at once by the worker
+    :return: None
+    """
+    configure_ocr(ocr_backend, ocr_workers)
+
+
+def initialise_pdf_pool_worker(ocr_backend, ocr_workers, pdf_batch_multiplier):
+    """
+    Process pool initializer for PDF workers, applying the OCR configuration and loading the marker models.
+    :param ocr_backend: OCR backend used for images found in archives
+    :param ocr_workers: number of tesseract processes run at once by the worker
+    :param pdf_batch_multiplier: multiplier of the marker models' batch sizes
+    :return: None
+    """
+    initialise_worker(ocr_backend, ocr_workers)
+    initialise_pdf_worker(pdf_batch_multiplier)
+
+
+def start_workers(pool):
+    """
+    Start the worker processes of a pool by running a task on it and waiting for the result.
+
+    Fork pools start all of their workers with the first task. Doing so before any other thread is started keeps
+    the workers from inheriting a lock held by another thread of this process, which would never be released.
+    :param pool: ProcessPoolExecutor
+    :return: the pool
+    """
+    pool.submit(int).result()
+    return pool
+
+
+def check_pmc_bioc_updates(workers=default_workers, pipeline_depth=default_pipeline_depth, stream=False,
+                           pdf_worker_memory_gb=default_pdf_worker_memory_gb, ocr_backend="remote",
+                           pdf_batch_multiplier=default_pdf_batch_multiplier):
     """
     Checks PMC-BioC archive FTP site for updates and processes them.
+
+    Archives are downloaded ahead of processing, so the download of the next archive overlaps the
+    processing of the current one. CPU-bound stages run in a process pool, with PDFs converted by a separate pool
+    whose workers load the marker models once at startup.
+    :param workers: number of processes used for CPU-bound stages
+    :param pipeline_depth: maximum number of archives held on disk at once, including the one being processed
+    :param stream: True to filter archive members without extracting the archives to disk
+    :param pdf_worker_memory_gb: physical memory reserved for each PDF worker, limiting how many run at once
+    :param ocr_backend: "remote" to use the OCR web service, or "local" to run tesseract with the web service as a
+    fallback
+    :param pdf_batch_multiplier: multiplier of the marker models' batch sizes in each PDF worker
     :return:
     """
+    # each worker runs its own tesseract processes, so the cores are shared between them
+    ocr_workers = max(1, (os.cpu_count() or 1) // max(1, workers))
+    configure_ocr(ocr_backend, ocr_workers)
     current_versions = get_current_version_dates()
-    archive_updated = False
     # Scan FTP address for updates using date modified
     with ftplib.FTP(ftp_server) as ftp:
         ftp.login()
         files = list_archives_with_dates(ftp, ftp_directory)
-    for filename, date_modified in files:
-        archive_processed = False
-        # Filter out any files that are not json_ascii.tar.gz
-        if "_json_ascii.tar.gz" not in filename:
-            continue
-        date_modified = date_modified.strftime("%Y-%m-%d %H:%M:%S")
-        # Check for updates to current files or brand-new ones
-        for [current_file, current_file_date] in current_versions:
-            if filename == current_file:
-                if current_file_date < date_modified:
-                    logger.info(F"Updating {filename}")
-                    # An update is found for the already stored archive
-                    with ftplib.FTP(ftp_server) as ftp:
-                        ftp.login()
-                        ftp.cwd(ftp_directory)
-                        download_archive(ftp, filename, "Output")
-                    update_existing_archive(os.path.join("Output", filename))
-                    update_local_archive_versions(filename, date_modified)
-                    archive_processed = True
-                    archive_updated = True
-                    break
+    pending_archives = get_pending_archives(files, current_versions)
+
+    slots = threading.BoundedSemaphore(max(1, pipeline_depth))
+    downloaded = queue.Queue()
+    downloader = threading.Thread(target=download_archives, args=(pending_archives, downloaded, slots),
+                                  daemon=True)
+    pdf_workers = get_pdf_worker_limit(workers, pdf_worker_memory_gb)
+    # Workers are started before the downloader thread, in case the platform forks them
+    with ProcessPoolExecutor(max_workers=max(1, workers), initializer=initialise_worker,
+                             initargs=(ocr_backend, ocr_workers)) as pool, \
+            ProcessPoolExecutor(max_workers=pdf_workers, initializer=initialise_pdf_pool_worker,
+                                initargs=(ocr_backend, ocr_workers, pdf_batch_multiplier)) as pdf_pool:
+        start_workers(pool)
+        start_workers(pdf_pool)
+        downloader.start()
+        while True:
+            archive = downloaded.get()
+            if archive is None:
+                break
+            filename, date_modified, new_archive = archive
+            try:
+                if new_archive:
+                    process_new_archive(os.path.join("Output", filename), pool, stream, workers, pdf_pool)
+                    update_local_archive_versions(filename, date_modified, True)
+                    logger.info(F"Processed new archive: {filename}")
                 else:
-                    archive_processed = True
-                    # Archive is already up-to-date
-                    break
-        # File was either updated or already up-to-date
-        if archive_processed:
-            # check if an update was carried out
-            if archive_updated:
-                # changes were made, so archive the new directories
-                logger.info(F"Updated archive: {filename}")
-                archive_updated = False
-            continue
-        # A new archive has been found for processing
-        logger.info(F"Downloading new archive: {filename}")
-        # download_file(ftp, filename, "Output")
-        with ftplib.FTP(ftp_server) as ftp:
-            ftp.login()
-            ftp.cwd(ftp_directory)
-            download_archive(ftp, filename, "Output")
-        process_new_archive(os.path.join("Output", filename))
-        update_local_archive_versions(filename, date_modified, True)
-        logger.info(F"Processed new archive: {filename}")
+                    update_existing_archive(os.path.join("Output", filename), pool, stream, workers)
+                    update_local_archive_versions(filename, date_modified)
+                    logger.info(F"Updated archive: {filename}")
+            finally:
+                # The archive has been re-packed, so the next download can start
+                slots.release()
+    downloader.join()
     print("Finished updating the clinical corpora.")
 
 
@@ -397,7 +628,26 @@ def run():
     """
     Workflow entry point
     """
-    check_pmc_bioc_updates()
+    parser = argparse.ArgumentParser("FAIRClinical Workflow", description="Gathers and standardises clinical case "
+                                                                           "reports from the PMC BioC archives.")
+    parser.add_argument("-w", "--workers", type=int, default=default_workers,
+                        help="Number of processes used for CPU-bound stages")
+    parser.add_argument("-d", "--pipeline-depth", type=int, default=default_pipeline_depth,
+                        help="Maximum number of archives held on disk at once")
+    parser.add_argument("-s", "--stream", action="store_true",
+                        help="Filter archive members in memory, writing only the case report articles to disk")
+    parser.add_argument("-m", "--pdf-worker-memory", type=float, default=default_pdf_worker_memory_gb,
+                        help="Physical memory in GB reserved for each PDF worker, limiting how many run at once")
+    parser.add_argument("-o", "--ocr-backend", choices=ocr_backends, default="remote",
+                        help="OCR backend for supplementary images; local runs tesseract, falling back to the remote "
+                             "OCR service")
+    parser.add_argument("-b", "--pdf-batch-multiplier", type=int, default=default_pdf_batch_multiplier,
+                        help="Multiplier of the marker models' batch sizes; higher values convert more pages at once "
+                             "but need more memory, so --pdf-worker-memory should be raised with it")
+    args = parser.parse_args()
+    check_pmc_bioc_updates(workers=args.workers, pipeline_depth=args.pipeline_depth, stream=args.stream,
+                           pdf_worker_memory_gb=args.pdf_worker_memory, ocr_backend=args.ocr_backend,
+                           pdf_batch_multiplier=args.pdf_batch_multiplier)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,16 @@
 import argparse
+import os
 import sys
 import tarfile
 from pathlib import Path
 
-from AC.supplementary_processor import archive_extensions, image_extensions, word_extensions, spreadsheet_extensions
+from AC.file_types import extension_types, archive_extensions, WORD, PDF, SPREADSHEET, IMAGE, POWERPOINT
 
 powerpoint_extensions = [".pptx", ".ppt"]
-word_extensions.append(".txt")
+# Report groups of each processed file type
+file_type_groups = {WORD: "Word", PDF: "PDF", SPREADSHEET: "Table", IMAGE: "Image", POWERPOINT: "Presentation"}
+extension_groups = {x: file_type_groups[y] for x, y in extension_types.items() if y in file_type_groups}
+extension_groups.update({**{x: "Presentation" for x in powerpoint_extensions}, ".txt": "Word"})
 
 total_processed_files = {"Table": 0, "Image": 0, "Word": 0, "Presentation": 0, "PDF": 0, "Total": 0}
 
@@ -16,21 +20,9 @@ def count_unique_processed_files(archive):
     files = [x.name for x in files if len(x.parts) > 3 and x.parts[-2] == "Processed"]
     files = list(set([x.rstrip("_bioc.json").rstrip("_tables.json") for x in files]))
     for file in files:
-        if any([file.lower().endswith(x) for x in spreadsheet_extensions]):
-            total_processed_files["Table"] += 1
-            continue
-        if any([file.lower().endswith(x) for x in image_extensions]):
-            total_processed_files["Image"] += 1
-            continue
-        if any([file.lower().endswith(x) for x in word_extensions]):
-            total_processed_files["Word"] += 1
-            continue
-        if any([file.lower().endswith(x) for x in powerpoint_extensions]):
-            total_processed_files["Presentation"] += 1
-            continue
-        if file.lower().endswith(".pdf"):
-            total_processed_files["PDF"] += 1
-            continue
+        file_group = extension_groups.get(os.path.splitext(file)[-1].lower())
+        if file_group:
+            total_processed_files[file_group] += 1
 
     total_processed_files["Total"] += len(files)
     return True
@@ -1,44 +1,314 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+import cv2
+import pytesseract
+import re
 import requests
+from requests.adapters import HTTPAdapter
 import json
 
+from FAIRClinicalWorkflow.SibilsCache import SibilsCache
+
+ocr_api_url = "https://ocrweb.text-analytics.ch/"
+ocr_url = F"{ocr_api_url}ocr/?max_time=7"
+sibils_url = "https://sibils.text-analytics.ch/api/fetch"
+# (connect, read) timeouts in seconds; the OCR service is asked to stop after 7 seconds of processing
+ocr_timeout = (10, 60)
+# Maximum number of OCR requests in flight at once for each client
+default_max_in_flight = 8
+# Number of ids requested in each SIBiLS call, keeping the request URL to a safe length
+sibils_batch_size = 50
+# OCR backends: "remote" uses the OCR web service, "local" runs tesseract and falls back to the web service
+ocr_backends = ["remote", "local"]
+ocr_backend = "remote"
+# Number of tesseract processes run at once by each local OCR pool
+local_ocr_workers = max(1, os.cpu_count() or 1)
+local_ocr_source = "Tesseract OCR (local)"
+tesseract_language = "eng"
+tesseract_config = "--psm 3 --oem 3"
+# Images are downscaled so their longest side is at most this many pixels before recognition
+max_ocr_dimension = 3000
+connection_error_reason = "Connection failed with OCR API while attempting to retrieve OCR results."
+
+__default_client = None
+__default_client_lock = threading.Lock()
+
+
+def initialise_local_ocr_worker():
+    # tesseract's own threading would compete with the other workers of the pool
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def preprocess_image(file):
+    """
+    Load an image for recognition as a binarised greyscale image, downscaled if larger than max_ocr_dimension.
+    :param file: path to the image file
+    :return: binarised image, or None if the image could not be read
+    """
+    image = cv2.imread(file, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+    scale = max_ocr_dimension / max(image.shape[:2])
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    threshold, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return binary
+
+
+def recognise_image(file):
+    """
+    Recognise the text of an image with tesseract. Runs in the local OCR worker processes.
+    :param file: path to the image file
+    :return: list of the text paragraphs, or None if the image could not be read or holds no text
+    """
+    image = preprocess_image(file)
+    if image is None:
+        return None
+    text = pytesseract.image_to_string(image, lang=tesseract_language, config=tesseract_config)
+    # tesseract separates paragraphs with blank lines
+    paragraphs = [" ".join(x.split()) for x in text.split("\n\n") if x.strip()]
+    return paragraphs if paragraphs else None
+
+
+class OcrClient:
+    """
+    Retrieves OCR results for supplementary images over pooled HTTP connections.
+
+    Requests are sent concurrently from a thread pool, so at most max_in_flight are outstanding at once, and every
+    request is bounded by a timeout so one slow image cannot stall the others. SIBiLS results can be prefetched
+    in batches into a cache, leaving only the images SIBiLS does not hold to be sent to the OCR service.
+    """
+
+    def __init__(self, max_in_flight=default_max_in_flight, timeout=ocr_timeout, cache=None, backend="remote",
+                 local_workers=local_ocr_workers):
+        if backend not in ocr_backends:
+            raise ValueError(F"Unknown OCR backend: {backend}")
+        self.timeout = timeout
+        self.cache = cache
+        self.backend = backend
+        self.__local_pool = None
+        if backend == "local":
+            self.__local_pool = ProcessPoolExecutor(max_workers=max(1, local_workers),
+                                                    initializer=initialise_local_ocr_worker)
+        self.max_in_flight = max(1, max_in_flight)
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.max_in_flight)
+        self.__session.mount("https://", adapter)
+        self.__session.mount("http://", adapter)
+        self.__executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+
+    def get_ocr_results(self, file):
+        """
+        Request OCR results for an image from the OCR service.
+        :param file: path to the image file
+        :return: tuple of the text paragraphs (or None), the service URL and the failure reason
+        """
+        try:
+            with open(file, "rb") as f:
+                response = self.__session.post(url=ocr_url, data=f.read(), timeout=self.timeout,
+                                               headers={'Content-Type': 'image/*', 'Accept': 'application/json'})
+            if response.status_code == 200:
+                result = response.json()
+                paragraphs = [x for x in result["ocr_output"].split("\n") if x]
+                return paragraphs, ocr_api_url, ""
+            else:
+                return None, ocr_api_url, ""
+        except (ConnectionError, requests.ConnectionError, requests.Timeout) as ce:
+            print(ce)
+            return None, None, connection_error_reason
+        except Exception as e:
+            print(F"get_ocr_results error occurred: {e}")
+            return None, None, connection_error_reason
+
+    def get_local_ocr_results(self, file):
+        """
+        Recognise the text of an image with tesseract in the local OCR pool.
+        :param file: path to the image file
+        :return: tuple of the text paragraphs (or None), the OCR source and the failure reason
+        """
+        try:
+            return self.__local_pool.submit(recognise_image, file).result(), local_ocr_source, ""
+        except Exception as e:
+            print(F"get_local_ocr_results error occurred: {e}")
+            return None, None, "Local OCR failed while attempting to recognise the image."
+
+    def fetch_sibils_documents(self, sibils_ids):
+        """
+        Request the documents of several supplementary files from SIBiLS in one call.
+        :param sibils_ids: list of SIBiLS ids (<PMCID>_<file name>)
+        :return: dictionary of the ids SIBiLS answered for to their BioC documents, or None for those it reported
+            missing. Ids which cannot be matched to the response are left out, to be requested individually.
+        """
+        response = self.__session.get(url=sibils_url, params={"ids": ",".join(sibils_ids), "col": "suppdata"},
+                                      timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        warning = result.get("warning") or ""
+        missing_ids = set()
+        if "missing ids:" in warning:
+            missing_ids = set(re.split(r"[\s,]+", warning.split("missing ids:", 1)[1].strip()))
+        documents = {x: None for x in sibils_ids if x in missing_ids}
+        for document in result.get("sibils_article_set", []):
+            sibils_id = document.get("_id", document.get("id"))
+            if sibils_id in sibils_ids:
+                documents[sibils_id] = document
+        return documents
+
+    def prefetch_sibils_ocr(self, files):
+        """
+        Cache the SIBiLS documents of many supplementary images using batched requests.
+
+        Images already cached are not requested again. Batches which fail are left uncached, so their images
+        are requested individually later.
+        :param files: list of (image file path, PMC ID) tuples
+        :return: number of images whose documents SIBiLS holds
+        """
+        if not self.cache:
+            return 0
+        sibils_ids = list(dict.fromkeys([get_sibils_id(file, pmcid) for file, pmcid in files]))
+        sibils_ids = self.cache.get_uncached(sibils_ids)
+        batches = [sibils_ids[i:i + sibils_batch_size] for i in range(0, len(sibils_ids), sibils_batch_size)]
+        found = 0
+        for documents in self.__executor.map(self.__fetch_batch, batches):
+            if documents is None:
+                continue
+            self.cache.store(documents)
+            found += len([x for x in documents.values() if x is not None])
+        return found
+
+    def __fetch_batch(self, sibils_ids):
+        try:
+            return self.fetch_sibils_documents(sibils_ids)
+        except Exception as e:
+            print(F"prefetch_sibils_ocr error occurred: {e}")
+            return None
+
+    def get_sibils_ocr(self, filename, pmcid):
+        """
+        Retrieve the OCR results already held by SIBiLS for a supplementary image, using the cache where possible.
+        :param filename: path to the image file
+        :param pmcid: PMC ID of the article the image belongs to
+        :return: tuple of the BioC document (or None), the request URL and the failure reason
+        """
+        try:
+            sibils_id = get_sibils_id(filename, pmcid)
+            url = F"{sibils_url}?ids={sibils_id}&col=suppdata"
+            if self.cache:
+                cached, bioc_doc = self.cache.get(sibils_id)
+                if cached:
+                    return bioc_doc, url, ""
+            response = self.__session.get(url=url, timeout=self.timeout)
+            if response.status_code == 200:
+                result = response.json()
+                bioc_doc = None
+                if "missing ids:" not in result['warning']:
+                    bioc_doc = result["sibils_article_set"][0]
+                if self.cache:
+                    self.cache.store({sibils_id: bioc_doc})
+                return bioc_doc, url, ""
+            return None, url, ""
+        except (ConnectionError, requests.ConnectionError, requests.Timeout) as ce:
+            print(ce)
+            return None, None, connection_error_reason
+        except Exception as e:
+            print(F"get_sibils_ocr error occurred: {e}")
+            return None, None, connection_error_reason
+
+    def get_image_text(self, file, pmcid=None):
+        """
+        Retrieve the text of an image from SIBiLS, falling back to the selected OCR backend and then to the OCR
+        service.
+        :param file: path to the image file
+        :param pmcid: PMC ID of the article the image belongs to
+        :return: tuple of the text (or None), the source URL and the failure reason
+        """
+        text, url, reason = self.get_sibils_ocr(file, pmcid)
+        if not text and self.__local_pool:
+            text, url, reason = self.get_local_ocr_results(file)
+        if not text:
+            text, url, reason = self.get_ocr_results(file)
+        return text, url, reason
+
+    def get_image_texts(self, files, pmcid=None):
+        """
+        Retrieve the text of several images of one article concurrently.
+        :param files: list of image file paths
+        :param pmcid: PMC ID of the article the images belong to
+        :return: list of (text, url, reason) tuples, in the order of the files
+        """
+        futures = [self.__executor.submit(self.get_image_text, file, pmcid) for file in files]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+        if self.__local_pool:
+            self.__local_pool.shutdown(wait=True)
+        self.__session.close()
+        if self.cache:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_sibils_id(filename, pmcid):
+    """
+    Build the SIBiLS id of a supplementary file.
+    :param filename: path to the supplementary file
+    :param pmcid: PMC ID of the article the file belongs to
+    :return: SIBiLS id of the file
+    """
+    return F"{pmcid}_{os.path.split(filename)[1]}"
+
+
+def get_default_client():
+    """
+    Retrieve the OCR client shared by this process, creating it on first use.
+    :return: OcrClient instance, using the shared SIBiLS cache
+    """
+    global __default_client
+    with __default_client_lock:
+        if __default_client is None:
+            __default_client = OcrClient(cache=SibilsCache(), backend=ocr_backend, local_workers=local_ocr_workers)
+        return __default_client
+
+
+def configure_ocr(backend="remote", workers=None):
+    """
+    Select the OCR backend used by the clients created in this process and the processes it starts.
+    :param backend: "remote" for the OCR web service, or "local" to run tesseract with the web service as a fallback
+    :param workers: number of tesseract processes run at once by each client, or None for one per core
+    :return: None
+    """
+    global ocr_backend, local_ocr_workers
+    if backend not in ocr_backends:
+        raise ValueError(F"Unknown OCR backend: {backend}")
+    ocr_backend = backend
+    if workers:
+        local_ocr_workers = max(1, workers)
+
+
+def prefetch_sibils_ocr(files):
+    """
+    Cache the SIBiLS documents of many supplementary images using batched requests.
+
+    A client of its own is used and closed afterwards, so no connections or threads are left open in a process
+    which later forks workers.
+    :param files: list of (image file path, PMC ID) tuples
+    :return: number of images whose documents SIBiLS holds
+    """
+    with OcrClient(cache=SibilsCache()) as client:
+        return client.prefetch_sibils_ocr(files)
+
 
 def get_ocr_results(file):
-    response = None
-    try:
-        with open(file, "rb") as f:
-            response = requests.post(url="https://ocrweb.text-analytics.ch/ocr/?max_time=7", data=f.read(),
-                                     headers={'Content-Type': 'image/*', 'Accept': 'application/json'})
-        if response.status_code == 200:
-            result = response.json()
-            paragraphs = [x for x in result["ocr_output"].split("\n") if x]
-            return paragraphs, "https://ocrweb.text-analytics.ch/", ""
-        else:
-            return None, "https://ocrweb.text-analytics.ch/", ""
-    except ConnectionError as ce:
-        print(ce)
-        return None, None, "Connection failed with OCR API while attempting to retrieve OCR results."
-    except Exception as e:
-        print(F"get_ocr_results error occurred: {e}")
-        return None, None, "Connection failed with OCR API while attempting to retrieve OCR results."
+    return get_default_client().get_ocr_results(file)
 
 
 def get_sibils_ocr(filename, pmcid):
-    try:
-        base_dir, filename = os.path.split(filename)
-        url = F"https://sibils.text-analytics.ch/api/fetch?ids={pmcid}_{filename}&col=suppdata"
-        response = requests.get(url=url)
-        if response.status_code == 200:
-            result = response.json()
-            if "missing ids:" in result['warning']:
-                return None, url, ""
-            bioc_doc = result["sibils_article_set"][0]
-            return bioc_doc, url, ""
-        return None, url, ""
-    except ConnectionError as ce:
-        print(ce)
-        return None, None, "Connection failed with OCR API while attempting to retrieve OCR results."
-    except Exception as e:
-        print(F"get_sibils_ocr error occurred: {e}")
-        return None, None, "Connection failed with OCR API while attempting to retrieve OCR results."
+    return get_default_client().get_sibils_ocr(filename, pmcid)
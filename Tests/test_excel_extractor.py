@@ -0,0 +1,27 @@
+import openpyxl
+import pandas as pd
+
+from FAIRClinicalWorkflow.AC.excel_extractor import iter_worksheet_rows
+
+
+def test_worksheet_rows_match_pandas(tmp_path):
+    path = tmp_path / "supplementary.xlsx"
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet.append(["id", "id", None, "id.1", "name", None, "id"])
+    worksheet.append(["a1", "b1", "c1", "d1", "e1", "f1", "g1"])
+    worksheet.append([None] * 7)
+    worksheet.append(["a3", None, "c3", None, "e3", None, "g3"])
+    # formatted cells extend the sheet with trailing blank rows
+    worksheet.cell(row=7, column=1).number_format = "0.00"
+    workbook.save(path)
+
+    expected = pd.read_excel(path)
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        columns, rows = iter_worksheet_rows(workbook.worksheets[0])
+        rows = list(rows)
+    finally:
+        workbook.close()
+    assert columns == list(expected.columns)
+    assert rows == [[str(x) for x in row] for row in expected.values]
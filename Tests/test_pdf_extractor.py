@@ -0,0 +1,47 @@
+import json
+from types import SimpleNamespace
+
+import pdfplumber
+from reportlab.pdfgen import canvas
+
+from FAIRClinicalWorkflow.AC.pdf_extractor import get_text_bioc, get_page_rotation
+
+
+def test_text_layer_passages_are_strings():
+    # text layer pages arrive as lists of lines, marker output as a string per run of pages
+    page_texts = [["First line of page one", "Second line of page one"], "Marker text\nSecond marker line"]
+    bioc = json.loads(json.dumps(get_text_bioc(page_texts, "Output/PMC1_supplementary/Raw/file.pdf")))
+    passages = bioc["documents"][0]["passages"]
+    assert [x["text"] for x in passages] == ["First line of page one", "Second line of page one", "Marker text",
+                                             "Second marker line"]
+    assert all([type(x["text"]) is str for x in passages]), "BioC passage text must be a string"
+    assert passages[1]["offset"] == len(passages[0]["text"])
+
+
+def write_rotated_pdf(path, rotations):
+    # each page holds a few lines of text drawn at one of the rotations, turning counter-clockwise
+    pdf = canvas.Canvas(str(path), pagesize=(600, 600))
+    for rotation in rotations:
+        pdf.translate(300, 300)
+        pdf.rotate(rotation)
+        for i in range(3):
+            pdf.drawString(-150, 40 - i * 20, "Supplementary table of patient characteristics")
+        pdf.showPage()
+    pdf.save()
+
+
+def test_page_rotation(tmp_path):
+    rotations = [0, 90, 180, 270]
+    write_rotated_pdf(tmp_path / "rotated.pdf", rotations)
+    with pdfplumber.open(tmp_path / "rotated.pdf") as pdf:
+        assert [get_page_rotation(page) for page in pdf.pages] == rotations
+
+
+def test_page_rotation_without_char_matrices(tmp_path):
+    rotations = [0, 90, 180, 270]
+    write_rotated_pdf(tmp_path / "rotated.pdf", rotations)
+    with pdfplumber.open(tmp_path / "rotated.pdf") as pdf:
+        # older pdfplumber releases do not give the matrix of each character
+        pages = [SimpleNamespace(chars=[{k: v for k, v in x.items() if k != "matrix"} for x in page.chars])
+                 for page in pdf.pages]
+        assert [get_page_rotation(page) for page in pages] == rotations
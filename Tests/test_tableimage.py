@@ -0,0 +1,25 @@
+import numpy as np
+
+from FAIRClinicalWorkflow.AC import tableimage
+from FAIRClinicalWorkflow.AC.tableimage import TableImage
+
+
+def test_row_words_are_assigned_to_cells(monkeypatch):
+    # two cells side by side, with the crop starting 3 pixels before the first
+    row = np.array([[10, 10, 50, 20], [70, 10, 50, 20]])
+    # word boxes are relative to the crop, which starts at (7, 7)
+    words = [
+        ("Age", 5, 5, 10, 10),
+        ("(years)", 20, 5, 20, 10),
+        ("", 40, 5, 5, 10),
+        ("42", 70, 5, 10, 10),
+        # between the two cells
+        ("|", 55, 5, 2, 10),
+        # part of the next row, included when a cell spans several rows
+        ("Sex", 70, 30, 10, 10),
+    ]
+    data = {"text": [x[0] for x in words], "left": [x[1] for x in words], "top": [x[2] for x in words],
+            "width": [x[3] for x in words], "height": [x[4] for x in words]}
+    monkeypatch.setattr(tableimage.pytesseract, "image_to_data", lambda *args, **kwargs: data)
+    image = np.zeros((100, 200), dtype=np.uint8)
+    assert TableImage([], "").row2text(image, row) == ["Age (years)", "42"]